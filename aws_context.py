@@ -1,10 +1,121 @@
+import copy
+import threading
+
+import boto3
+import boto3.session
+import botocore.config
+import botocore.session
+
+import rate_limiter
+import run_stats
+import thread_pool
+
 
 class AWSContext(object):
 
     def __init__(self, eventwriter, access_key,
-                 secret_key, region, concurrency):
+                 secret_key, region, concurrency, rate_limits=None,
+                 endpoint_urls=None, stats=None):
         self.eventwriter = eventwriter
         self.access_key = access_key
         self.secret_key = secret_key
         self.region = region
         self.concurrency = concurrency
+        self.pool = thread_pool.ThreadPool(concurrency)
+        self.rate_limiters = rate_limiter.RateLimiters(rate_limits)
+        # service name => endpoint URL, for stand-ins of AWS endpoints
+        self.endpoint_urls = endpoint_urls or {}
+        self.stats = stats or run_stats.RunStats()
+        self._clients = {}
+        self._sessions = {}
+        self._clients_lock = threading.Lock()
+
+    def for_region(self, region, eventwriter):
+        '''
+        :return: a context for another region sharing credentials, clients,
+        the thread pool, the rate limiters and the stats with this one
+        '''
+
+        context = copy.copy(self)
+        context.region = region
+        context.eventwriter = eventwriter
+        return context
+
+    def for_process(self, eventwriter, concurrency, num_processes):
+        '''
+        :return: a context for a forked worker process, with clients, a
+        thread pool, rate limiters and run stats of its own. The rates are
+        divided among ``num_processes`` processes, the stats are sent to the
+        parent through RunStats.process_state().
+        '''
+
+        rates = dict(
+            (name, rate / float(num_processes))
+            for name, rate in self.rate_limiters.rates.iteritems())
+        return AWSContext(
+            eventwriter, self.access_key, self.secret_key, self.region,
+            concurrency, rate_limits=rates, endpoint_urls=self.endpoint_urls)
+
+    def client(self, service_name, region_name=None, raw_timestamps=False,
+               pool_size=None):
+        '''
+        botocore clients are thread safe, so all threads share one client
+        per service/region and its connection pool, which is sized to
+        concurrency.
+        :param region_name: defaults to the region of this context
+        :param raw_timestamps: return timestamps as the strings sent by the
+        service instead of parsing them into datetime, which is costly
+        :param pool_size: connections kept by a client for a pool of threads
+        of its own, defaults to concurrency
+        '''
+
+        region_name = region_name or self.region
+        key = (service_name, region_name, raw_timestamps, pool_size)
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+
+        # Creating clients is not thread safe
+        with self._clients_lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._create_client(
+                    service_name, region_name, raw_timestamps, pool_size)
+                self.rate_limiters.attach(client, service_name, region_name)
+                self.stats.attach(client, service_name, region_name)
+                self._clients[key] = client
+        return client
+
+    def close(self):
+        self.pool.shutdown()
+        self.rate_limiters.report()
+        self.stats.close()
+
+    def _create_client(self, service_name, region_name, raw_timestamps,
+                       pool_size):
+        endpoint_url = self.endpoint_urls.get(service_name)
+        config = botocore.config.Config(
+            max_pool_connections=max(pool_size or self.concurrency, 10),
+            s3={'addressing_style': 'path'} if endpoint_url else None)
+        session = boto3
+        if raw_timestamps:
+            session = self._raw_timestamps_session()
+        return session.client(
+            service_name,
+            region_name=region_name,
+            aws_access_key_id=self.access_key,
+            aws_secret_access_key=self.secret_key,
+            endpoint_url=endpoint_url,
+            config=config,
+        )
+
+    def _raw_timestamps_session(self):
+        session = self._sessions.get('raw_timestamps')
+        if session is None:
+            botocore_session = botocore.session.get_session()
+            botocore_session.get_component(
+                'response_parser_factory').set_parser_defaults(
+                    timestamp_parser=lambda value: value)
+            session = boto3.session.Session(botocore_session=botocore_session)
+            self._sessions['raw_timestamps'] = session
+        return session
@@ -1,11 +1,22 @@
 #!/usr/bin/python
 
+import sys
+
+import engines
+engines.setup(engines.requested_engine(sys.argv[1:]))
+
 import argparse
+import json
 import logging
+import os
+import threading
 
+import batch_snaps
 import snaps
 import aws_context as ctx
 import event_writer as ew
+import rate_limiter
+import run_stats
 import boto3
 
 
@@ -17,6 +28,87 @@ def init():
     boto3.DEFAULT_SESSION._session.get_component('credential_provider')
 
 
+SNAP_MAP = {
+    's3': snaps.s3_snap.new_snapper,
+    'cloudwatch': snaps.cloudwatch_snap.new_snapper,
+    'kinesis': snaps.kinesis_snap.new_snapper,
+}
+
+SERVICE_NAMES = {
+    's3': 's3',
+    'cloudwatch': 'cloudwatch',
+    'kinesis': 'kinesis',
+}
+
+
+def get_regions(region, service_name):
+    '''
+    :param region: a region, comma separated regions or "all"
+    '''
+
+    if region == 'all':
+        return boto3.DEFAULT_SESSION.get_available_regions(service_name)
+    return [r.strip() for r in region.split(',') if r.strip()]
+
+
+def region_fname(fname, region):
+    '''
+    Insert the region before the extensions, like s3_meta.us-east-1.json.gz
+    '''
+
+    dirname, basename = os.path.split(fname)
+    name, dot, exts = basename.partition('.')
+    return os.path.join(dirname, '{}.{}{}{}'.format(name, region, dot, exts))
+
+
+def run_snaps(snappers):
+    '''
+    Run snappers concurrently, each snap() on its own thread. They share
+    the pool of their context for the actual collection.
+    '''
+
+    if len(snappers) == 1:
+        snappers[0].snap()
+        return
+
+    threads = []
+    for snapper in snappers:
+        thread = threading.Thread(target=snapper.snap)
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+
+def new_context(args, region, stats):
+    return ctx.AWSContext(
+        None, args.access_key, args.secret_key,
+        region, args.concurrency,
+        rate_limits=rate_limiter.parse_rates(args.rate_limits),
+        endpoint_urls=dict(url.split('=', 1) for url in args.endpoint_urls),
+        stats=stats)
+
+
+def run_batch(args, new_writer, stats):
+    context = new_context(args, args.region, stats)
+    try:
+        batch = batch_snaps.BatchSnapper(
+            context, batch_snaps.load_jobs(args.job_file), new_writer,
+            SNAP_MAP, args.max_jobs)
+        summary = batch.snap()
+    finally:
+        context.close()
+
+    with open(args.summary_file, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    failed = [job['name'] for job in summary if job['status'] != 'done']
+    logging.warn(
+        'Batch job_file=%s jobs=%d failed=%d summary_file=%s',
+        args.job_file, len(summary), len(failed), args.summary_file)
+
+
 def main():
     logging.basicConfig(level=logging.WARNING)
     init()
@@ -29,36 +121,108 @@ def main():
     parser.add_argument(
         '--secret_key', dest='secret_key', required=True, help='AWS secret_key')
     parser.add_argument(
-        '--region', dest='region', required=True, help='AWS region')
+        '--region', dest='region', required=True,
+        help='AWS region, comma separated regions or "all". Regions are '
+             'snapped concurrently in one process')
     parser.add_argument(
         '--target_file', dest='fname', required=False,
-        help='File name to store the meta data collected')
+        help='File name to store the meta data collected, a .db, .sqlite '
+             'or .sqlite3 suffix loads it into a SQLite database')
     parser.add_argument(
         '--concurrency', dest='concurrency', required=False,
         type=int, default=16, help='number of threads')
+    parser.add_argument(
+        '--write_buffer_size', dest='write_buffer_size', required=False,
+        type=int, default=ew.DEFAULT_BUFFER_SIZE,
+        help='Output buffer size in bytes')
+    parser.add_argument(
+        '--compression', dest='compression', required=False,
+        choices=ew.COMPRESSIONS, default='auto',
+        help='Output compression, "auto" picks it from the --target_file '
+             'suffix (.gz or .zst)')
+    parser.add_argument(
+        '--rate_limit', dest='rate_limits', action='append', default=[],
+        help='Max calls per second like s3=500 or kinesis.ListShards=50, '
+             'adapted down on throttling. Can be repeated')
+    parser.add_argument(
+        '--endpoint_url', dest='endpoint_urls', action='append', default=[],
+        help='Endpoint of a service like s3=http://localhost:4566, for '
+             'AWS stand-ins. Can be repeated')
+    parser.add_argument(
+        '--stats_file', dest='stats_file', default=None,
+        help='File to write per API call latency, retries and throttles, '
+             'queue depths and writer throughput to as JSON')
+    parser.add_argument(
+        '--stats_interval', dest='stats_interval', type=int, default=0,
+        help='Seconds between writes of --stats_file while running, 0 '
+             'writes it only at the end')
+    parser.add_argument(
+        '--engine', dest='engine', choices=engines.ENGINES, default='thread',
+        help='"gevent" runs the --concurrency workers as greenlets, for '
+             'concurrency in the hundreds')
+    parser.add_argument(
+        '--single_output', dest='single_output', action='store_true',
+        default=False,
+        help='With several regions write all of them into --target_file, '
+             'tagging records with Region, instead of one file per region')
 
     subparsers = parser.add_subparsers(dest="cmd")
     for mod in snaps.snaps:
         mod.add_params(subparsers)
+    batch_snaps.add_params(subparsers)
 
     args = parser.parse_args()
+    stats = run_stats.RunStats(args.stats_file, args.stats_interval)
 
-    if not args.fname:
-        args.fname = '{}_meta.json'.format(args.cmd)
+    def new_writer(fname, mode='w'):
+        writer = ew.new_writer(
+            fname, mode, buffer_size=args.write_buffer_size,
+            compression=args.compression)
+        stats.watch_writer(fname, writer)
+        return writer
 
-    writer = ew.JsonEventWriter(args.fname)
-    context = ctx.AWSContext(
-        writer, args.access_key, args.secret_key,
-        args.region, args.concurrency)
+    if args.engine == 'gevent' and getattr(args, 'processes', 1) > 1:
+        parser.error('--processes can not be combined with --engine gevent')
 
-    snap_map = {
-        's3': snaps.s3_snap.new_snapper,
-        'cloudwatch': snaps.cloudwatch_snap.new_snapper,
-        'kinesis': snaps.kinesis_snap.new_snapper,
-    }
+    if args.cmd == 'batch':
+        run_batch(args, new_writer, stats)
+        return
 
-    snapper = snap_map[args.cmd](context, args)
-    snapper.snap()
+    regions = get_regions(args.region, SERVICE_NAMES[args.cmd])
+    if not regions:
+        parser.error('No region in --region {}'.format(args.region))
+    if args.cmd == 's3' and len(regions) > 1:
+        parser.error('S3 buckets are global, snap them with one --region')
+
+    if not args.fname:
+        args.fname = '{}_meta.json{}'.format(
+            args.cmd, ew.COMPRESSION_SUFFIXES.get(args.compression, ''))
+
+    # A resumed snap appends to the output of the failed one
+    mode = 'a' if getattr(args, 'resume', False) else 'w'
+    context = new_context(args, regions[0], stats)
+
+    shared_writer = None
+    if len(regions) > 1 and args.single_output:
+        shared_writer = ew.SharedEventWriter(new_writer(args.fname, mode))
+
+    snappers = []
+    for region in regions:
+        if len(regions) == 1:
+            writer = new_writer(args.fname, mode)
+        elif shared_writer is not None:
+            writer = shared_writer.tagged({'Region': region})
+        else:
+            writer = new_writer(region_fname(args.fname, region), mode)
+        snappers.append(
+            SNAP_MAP[args.cmd](context.for_region(region, writer), args))
+
+    try:
+        run_snaps(snappers)
+    finally:
+        if shared_writer is not None:
+            shared_writer.close()
+        context.close()
 
 
 if __name__ == '__main__':
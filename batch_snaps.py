@@ -0,0 +1,178 @@
+import argparse
+import json
+import logging
+import threading
+import time
+import traceback
+
+import event_writer as ew
+import snaps
+
+
+def load_jobs(job_file):
+    '''
+    :param job_file: JSON file with a list of jobs, or {"jobs": [...]}. A job
+    is a dict with "cmd" (s3, cloudwatch or kinesis), optional "name",
+    "region" and "target_file", plus the options of that snap without the
+    leading dashes, like {"cmd": "s3", "bucket_name": "logs"}
+    '''
+
+    with open(job_file) as f:
+        jobs = json.load(f)
+
+    if isinstance(jobs, dict):
+        jobs = jobs['jobs']
+    return jobs
+
+
+def _snap_parser():
+    parser = argparse.ArgumentParser(prog='batch job')
+    subparsers = parser.add_subparsers(dest='cmd')
+    for mod in snaps.snaps:
+        mod.add_params(subparsers)
+    return parser
+
+
+def _job_argv(job):
+    argv = [job['cmd']]
+    for key, value in sorted(job.iteritems()):
+        if key in ('cmd', 'name', 'region', 'target_file'):
+            continue
+
+        if value is True:
+            argv.append('--' + key)
+        elif value is False or value is None:
+            continue
+        elif isinstance(value, (dict, list)):
+            argv.extend(('--' + key, json.dumps(value)))
+        else:
+            argv.extend(('--' + key, unicode(value)))
+    return argv
+
+
+class BatchJob(object):
+
+    def __init__(self, name, region, target_file, args):
+        self.name = name
+        self.region = region
+        self.target_file = target_file
+        self.args = args
+        self.status = 'pending'
+        self.discovered = None
+        self.took = None
+
+    def summary(self):
+        return {
+            'name': self.name,
+            'cmd': self.args.cmd,
+            'region': self.region,
+            'target_file': self.target_file,
+            'status': self.status,
+            'discovered': self.discovered,
+            'took': self.took,
+        }
+
+
+class BatchSnapper(object):
+    '''
+    Runs many snap jobs in one process. All jobs share the clients, the
+    thread pool and the rate limiters of one AWSContext, at most
+    ``max_jobs`` of them run at once, and jobs with the same target file
+    share its writer.
+    '''
+
+    def __init__(self, awscontext, jobs, new_writer, snap_map, max_jobs):
+        self.ctx = awscontext
+        self.new_writer = new_writer
+        self.snap_map = snap_map
+        self._job_slots = threading.Semaphore(max_jobs)
+        self.jobs = self._parse_jobs(jobs)
+
+    def _parse_jobs(self, jobs):
+        parser = _snap_parser()
+        batch_jobs = []
+        for i, job in enumerate(jobs):
+            name = job.get('name') or '{}_{}'.format(job['cmd'], i)
+            target_file = job.get('target_file') or '{}.json'.format(name)
+            args = parser.parse_args(_job_argv(job))
+            batch_jobs.append(BatchJob(
+                name, job.get('region') or self.ctx.region, target_file,
+                args))
+        return batch_jobs
+
+    def snap(self):
+        writers, shared_writers = self._create_writers()
+
+        threads = []
+        for job in self.jobs:
+            thread = threading.Thread(
+                target=self._run_job, args=(job, writers[job.name]))
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        for writer in shared_writers:
+            writer.close()
+
+        return [job.summary() for job in self.jobs]
+
+    def _create_writers(self):
+        by_target = {}
+        for job in self.jobs:
+            by_target.setdefault(job.target_file, []).append(job)
+
+        writers, shared_writers = {}, []
+        for target_file, jobs in by_target.iteritems():
+            mode = 'a' if getattr(jobs[0].args, 'resume', False) else 'w'
+            if len(jobs) > 1 and any(
+                    getattr(job.args, 'checkpoint_file', None)
+                    for job in jobs):
+                # Resuming truncates the file to the checkpoint offset
+                raise Exception(
+                    'Jobs with a checkpoint_file need a target_file of their '
+                    'own, target_file={}'.format(target_file))
+            writer = self.new_writer(target_file, mode)
+            if len(jobs) == 1:
+                writers[jobs[0].name] = writer
+                continue
+
+            # Records of jobs sharing a file are tagged with their job
+            shared = ew.SharedEventWriter(writer)
+            shared_writers.append(shared)
+            for job in jobs:
+                writers[job.name] = shared.tagged({'Job': job.name})
+        return writers, shared_writers
+
+    def _run_job(self, job, writer):
+        with self._job_slots:
+            start = time.time()
+            job.status = 'running'
+            try:
+                context = self.ctx.for_region(job.region, writer)
+                snapper = self.snap_map[job.args.cmd](context, job.args)
+                job.discovered = snapper.snap()
+            except Exception:
+                logging.error(
+                    'Failed to run batch job=%s error=%s',
+                    job.name, traceback.format_exc())
+
+            job.status = 'done' if job.discovered is not None else 'failed'
+            job.took = time.time() - start
+            logging.warn(
+                'Batch job=%s status=%s discovered=%s took=%s seconds',
+                job.name, job.status, job.discovered, job.took)
+
+
+def add_params(subparsers):
+    batch_parser = subparsers.add_parser('batch')
+    batch_parser.add_argument(
+        '--job_file', dest='job_file', required=True,
+        help='JSON file listing s3/cloudwatch/kinesis snap jobs')
+    batch_parser.add_argument(
+        '--max_jobs', dest='max_jobs', type=int, default=4,
+        help='Number of jobs running at once')
+    batch_parser.add_argument(
+        '--summary_file', dest='summary_file', default='batch_summary.json',
+        help='File to write per job status and timing to')
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+'''
+Micro-benchmark of CloudWatch dimension filter matching: the compiled
+DimensionFilterIndex against a list of DimensionExactMatcher.
+
+    python benchmarks/bench_dimension_matcher.py --filters 200 --metrics 100000
+'''
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'snaps'))
+
+import cloudwatch_snap as cw
+
+
+DIMENSION_SETS = [
+    ('InstanceId',),
+    ('AutoScalingGroupName',),
+    ('ImageId',),
+    ('InstanceType',),
+    ('LoadBalancerName', 'AvailabilityZone'),
+]
+
+
+def gen_filters(num_filters, rand):
+    filters = []
+    for i in xrange(num_filters):
+        names = rand.choice(DIMENSION_SETS)
+        filters.append(
+            {name: '{}-{:04x}.*'.format(name.lower(), rand.randint(0, 0xfff))
+             for name in names})
+    return filters
+
+
+def gen_metrics(num_metrics, rand):
+    metrics = []
+    for i in xrange(num_metrics):
+        names = rand.choice(DIMENSION_SETS)
+        metrics.append([
+            {'Name': name,
+             'Value': '{}-{:04x}{:08x}'.format(
+                 name.lower(), rand.randint(0, 0xfff), i)}
+            for name in names])
+    return metrics
+
+
+def bench(name, match, metrics):
+    start = time.time()
+    matched = sum(1 for dimensions in metrics if match(dimensions))
+    took = time.time() - start
+    print '{:<24} matched={:<8d} took={:.3f}s metrics/sec={:.0f}'.format(
+        name, matched, took, len(metrics) / took)
+    return matched
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filters', type=int, default=200)
+    parser.add_argument('--metrics', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    filters = gen_filters(args.filters, rand)
+    metrics = gen_metrics(args.metrics, rand)
+
+    matchers = [cw.DimensionExactMatcher(dict(f)) for f in filters]
+    index = cw.get_dimension_filters(filters)
+
+    def match_all(dimensions):
+        for matcher in matchers:
+            if matcher.exact_match(dimensions):
+                return True
+        return False
+
+    print 'filters={} metrics={}'.format(args.filters, args.metrics)
+    expected = bench('DimensionExactMatcher', match_all, metrics)
+    got = bench('DimensionFilterIndex', index.match, metrics)
+    assert expected == got, 'Matchers disagree'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+
+'''
+Benchmark of S3 key records: boto3 dicts with datetime LastModified,
+converted and serialized with json.dumps, against KeyMeta built from raw
+timestamps and serialized through to_json(). Reports throughput of
+parse + convert + serialize per listing page, and the memory held by
+--records records, each measured in a forked child.
+
+    python benchmarks/bench_key_records.py --pages 20 --records 1000000
+'''
+
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'snaps'))
+
+import botocore.parsers
+import botocore.session
+
+import fake_aws
+import s3_records
+
+
+def dict_records(contents):
+    for key in contents:
+        key['LastModified'] = str(key['LastModified'])
+        key.pop('ETag', None)
+    return contents
+
+
+def dict_serialize(records):
+    return [json.dumps(record) for record in records]
+
+
+def compact_serialize(records):
+    return [record.to_json() for record in records]
+
+
+PATHS = {
+    'dict': (None, dict_records, dict_serialize),
+    'compact': (lambda value: value, s3_records.from_listing,
+                compact_serialize),
+}
+
+
+def listing_page(num_keys):
+    args = argparse.Namespace(
+        keys=num_keys, prefixes=16, skew=0.0, plain_rate=0.0, metrics=0,
+        dimensions=0, streams=0, shards=0, latency=0, throttle_rate=0)
+    fake = fake_aws.FakeAWS(args)
+    return fake.list_objects_v2({'max-keys': str(num_keys)})
+
+
+def parse_page(parser, shape, body):
+    return parser.parse(
+        {'body': body, 'headers': {}, 'status_code': 200},
+        shape)['Contents']
+
+
+def bench_throughput(path, body, shape, pages):
+    timestamp_parser, convert, serialize = PATHS[path]
+    parser = botocore.parsers.RestXMLParser(timestamp_parser=timestamp_parser)
+
+    parse_time = convert_time = serialize_time = 0.0
+    num_records = 0
+    for i in xrange(pages):
+        start = time.time()
+        contents = parse_page(parser, shape, body)
+        parsed = time.time()
+        records = convert(contents)
+        converted = time.time()
+        serialize(records)
+        serialize_time += time.time() - converted
+        convert_time += converted - parsed
+        parse_time += parsed - start
+        num_records += len(records)
+
+    took = parse_time + convert_time + serialize_time
+    print ('{:<8} records_per_sec={:>8.0f} parse={:.2f}s convert={:.2f}s '
+           'serialize={:.2f}s'.format(
+               path, num_records / took, parse_time, convert_time,
+               serialize_time))
+
+
+def bench_memory(path, body, shape, num_records):
+    '''
+    Hold ``num_records`` records in a forked child
+    :return: peak RSS growth in MB
+    '''
+
+    pid = os.fork()
+    if not pid:
+        timestamp_parser, convert, _ = PATHS[path]
+        parser = botocore.parsers.RestXMLParser(
+            timestamp_parser=timestamp_parser)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        held = []
+        while len(held) < num_records:
+            held.extend(convert(parse_page(parser, shape, body)))
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in KB on Linux
+        print '{:<8} records={} held_mb={:.1f} bytes_per_record={:.0f}'.format(
+            path, len(held), (after - before) / 1024.0,
+            (after - before) * 1024.0 / len(held))
+        sys.stdout.flush()
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=20,
+                        help='Listing pages of 1000 keys for throughput')
+    parser.add_argument('--records', type=int, default=500000,
+                        help='Records held for the memory comparison')
+    args = parser.parse_args()
+
+    body = listing_page(1000)
+    shape = botocore.session.get_session().get_service_model(
+        's3').operation_model('ListObjectsV2').output_shape
+
+    for path in ('dict', 'compact'):
+        bench_throughput(path, body, shape, args.pages)
+    for path in ('dict', 'compact'):
+        bench_memory(path, body, shape, args.records)
+
+
+if __name__ == '__main__':
+    main()
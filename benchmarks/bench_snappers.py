@@ -0,0 +1,136 @@
+#!/usr/bin/python
+
+'''
+End to end benchmark of the snappers against benchmarks/fake_aws.py. Each
+snapper, engine and concurrency level runs aws_snaps.py in its own process,
+and records/sec, API calls, throttles, peak RSS and wall time are reported.
+
+    python benchmarks/bench_snappers.py --snappers s3,kinesis \
+        --concurrency 1,4,16 --keys 500000 --skew 0.9 --latency 0.05
+
+    python benchmarks/bench_snappers.py --snappers s3 --engines thread,gevent \
+        --concurrency 64,256 --prefixes 256 --latency 0.2
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+
+import fake_aws
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+FAKE_AWS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fake_aws.py')
+
+SNAPPER_ARGS = {
+    's3': ['s3', '--bucket_name', 'bucket'],
+    'cloudwatch': ['cloudwatch', '--namespace', 'AWS/EC2', '--metrics', ','.join(
+        'Metric{:03d}'.format(i) for i in xrange(5))],
+    'kinesis': ['kinesis'],
+}
+
+
+def start_server(args):
+    argv = [sys.executable, FAKE_AWS]
+    for name in ('keys', 'prefixes', 'skew', 'plain_rate', 'metrics',
+                 'dimensions', 'streams', 'shards', 'latency',
+                 'throttle_rate'):
+        argv.extend(('--' + name, str(getattr(args, name))))
+    server = subprocess.Popen(argv, stdout=subprocess.PIPE)
+    port = int(server.stdout.readline())
+    return server, 'http://127.0.0.1:{}'.format(port)
+
+
+def _server_call(endpoint, path, data=None):
+    return json.load(urllib2.urlopen(endpoint + path, data))
+
+
+def run_snapper(snapper, engine, concurrency, endpoint, workdir):
+    target_file = os.path.join(
+        workdir, '{}_{}_{}.json'.format(snapper, engine, concurrency))
+    argv = [
+        sys.executable, os.path.join(ROOT, 'aws_snaps.py'),
+        '--access_key', 'bench', '--secret_key', 'bench',
+        '--region', 'us-east-1', '--concurrency', str(concurrency),
+        '--engine', engine, '--target_file', target_file,
+    ]
+    for service in ('s3', 'cloudwatch', 'kinesis'):
+        argv.extend(('--endpoint_url', '{}={}'.format(service, endpoint)))
+    argv.extend(SNAPPER_ARGS[snapper])
+
+    _server_call(endpoint, '/__reset', '')
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        process = subprocess.Popen(argv, stderr=devnull)
+        _, status, rusage = os.wait4(process.pid, 0)
+        took = time.time() - start
+    stats = _server_call(endpoint, '/__stats')
+
+    records = 0
+    if os.path.exists(target_file):
+        with open(target_file) as f:
+            records = sum(1 for _ in f)
+        os.remove(target_file)
+
+    return {
+        'snapper': snapper,
+        'engine': engine,
+        'concurrency': concurrency,
+        'status': os.WEXITSTATUS(status),
+        'records': records,
+        'records_per_sec': records / took if took else 0,
+        'api_calls': sum(stats['calls'].values()),
+        'throttles': sum(stats['throttles'].values()),
+        # ru_maxrss is in KB on Linux
+        'peak_rss_mb': rusage.ru_maxrss / 1024.0,
+        'took': took,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--snappers', default='s3,cloudwatch,kinesis')
+    parser.add_argument('--engines', default='thread',
+                        help='Comma separated engines, thread and/or gevent')
+    parser.add_argument('--concurrency', default='1,4,16',
+                        help='Comma separated concurrency levels')
+    parser.add_argument('--output', default=None,
+                        help='File to write the results to as JSON')
+    fake_aws.add_params(parser)
+    args = parser.parse_args()
+
+    server, endpoint = start_server(args)
+    workdir = tempfile.mkdtemp(prefix='bench_snappers.')
+    results = []
+    try:
+        print ('{:<11} {:<7} {:>5} {:>6} {:>9} {:>12} {:>9} {:>9} {:>8} '
+               '{:>8}'.format(
+                   'snapper', 'engine', 'conc', 'status', 'records',
+                   'records/sec', 'api_calls', 'throttles', 'rss_mb', 'took'))
+        for snapper in args.snappers.split(','):
+            for concurrency in args.concurrency.split(','):
+                for engine in args.engines.split(','):
+                    result = run_snapper(
+                        snapper, engine, int(concurrency), endpoint, workdir)
+                    results.append(result)
+                    print ('{snapper:<11} {engine:<7} {concurrency:>5} '
+                           '{status:>6} {records:>9} {records_per_sec:>12.0f} '
+                           '{api_calls:>9} {throttles:>9} '
+                           '{peak_rss_mb:>8.1f} {took:>8.2f}'.format(**result))
+                    sys.stdout.flush()
+    finally:
+        server.terminate()
+        os.rmdir(workdir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/python
+
+'''
+Benchmark of the event writers: bulk loads --records synthetic S3 key
+records through JsonEventWriter and SqliteEventWriter in write batches of
+--batch_records and reports records/sec, including closing the writer,
+which builds the SQLite indexes.
+
+    python benchmarks/bench_writers.py --records 1000000
+'''
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'snaps'))
+
+import event_writer
+import fake_aws
+import s3_records
+
+
+def key_records(num_records):
+    keys = fake_aws.gen_keys(num_records, 16, 0.0)
+    return [s3_records.KeyMeta(key, len(key) * 1000, 1472731200.0 + i,
+                               'STANDARD')
+            for i, key in enumerate(keys)]
+
+
+def bench(name, writer, records, batch_records):
+    start = time.time()
+    with writer:
+        for i in xrange(0, len(records), batch_records):
+            writer.write(records[i:i + batch_records])
+    took = time.time() - start
+    print '{:<8} records={} records_per_sec={:>8.0f} bytes={} took={:.2f}s' \
+        .format(name, len(records), len(records) / took,
+                writer.bytes_written, took)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=500000)
+    parser.add_argument('--batch_records', type=int, default=5000)
+    args = parser.parse_args()
+
+    records = key_records(args.records)
+    workdir = tempfile.mkdtemp(prefix='bench_writers.')
+    try:
+        bench('json', event_writer.JsonEventWriter(
+            os.path.join(workdir, 's3_meta.json')), records,
+            args.batch_records)
+        bench('json.gz', event_writer.JsonEventWriter(
+            os.path.join(workdir, 's3_meta.json.gz')), records,
+            args.batch_records)
+        bench('sqlite', event_writer.SqliteEventWriter(
+            os.path.join(workdir, 's3_meta.db')), records,
+            args.batch_records)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,395 @@
+#!/usr/bin/python
+
+'''
+Local stand-in for the AWS APIs the snappers call, serving synthetic data
+with configurable latency and throttling, for benchmarks.
+
+- S3 ListObjectsV2 (path style) of one bucket with --keys keys spread over
+  --prefixes top level prefixes, --skew of them under the first prefix
+- S3 GetObject of those keys, honouring Range. Objects start like gzip
+  files, but --plain_rate of them hold plain text
+- CloudWatch ListMetrics of --metrics metric names with --dimensions
+  dimension values each, in any namespace
+- Kinesis ListStreams / DescribeStream(Summary) / ListShards of --streams
+  streams with --shards shards each
+
+GET /__stats returns per API call and throttle counts, POST /__reset
+clears them.
+
+    python benchmarks/fake_aws.py --port 8000 --keys 1000000 --skew 0.9
+'''
+
+import argparse
+import base64
+import bisect
+import BaseHTTPServer
+import collections
+import json
+import random
+import SocketServer
+import sys
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+from xml.sax.saxutils import escape
+
+
+S3_NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+CLOUDWATCH_NS = 'http://monitoring.amazonaws.com/doc/2010-08-01/'
+LAST_MODIFIED = '2016-09-01T12:00:00.000Z'
+CLOUDWATCH_PAGE = 500
+GZIP_HEADER = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03'
+PLAIN_LINE = '2016-09-01T12:00:00Z fake log line\n'
+
+
+def gen_keys(num_keys, num_prefixes, skew):
+    '''
+    Date partitioned keys like AWSLogs/0003/2016/09/01/00001234.log.gz,
+    ``skew`` of them under the first prefix
+    '''
+
+    keys = []
+    hot = int(num_keys * skew)
+    for i in xrange(num_keys):
+        if i < hot or num_prefixes == 1:
+            prefix = 0
+        else:
+            prefix = 1 + i % (num_prefixes - 1)
+        keys.append('AWSLogs/{:04d}/2016/09/{:02d}/{:08d}.log.gz'.format(
+            prefix, 1 + i % 30, i))
+    keys.sort()
+    return keys
+
+
+def _encode_token(value):
+    return base64.urlsafe_b64encode(value)
+
+
+def _decode_token(token):
+    return base64.urlsafe_b64decode(str(token))
+
+
+class FakeAWS(object):
+
+    def __init__(self, args):
+        self.latency = args.latency
+        self.throttle_rate = args.throttle_rate
+        self.plain_rate = args.plain_rate
+        self.keys = gen_keys(args.keys, args.prefixes, args.skew)
+        self.metrics = ['Metric{:03d}'.format(i) for i in xrange(args.metrics)]
+        self.dimensions = args.dimensions
+        self.streams = ['stream-{:05d}'.format(i)
+                        for i in xrange(args.streams)]
+        self.shards = args.shards
+        self.calls = collections.Counter()
+        self.throttles = collections.Counter()
+        self._lock = threading.Lock()
+        self._random = random.Random(1)
+
+    def count(self, api):
+        '''
+        Account a call and inject latency
+        :return: True if the call is to be throttled
+        '''
+
+        with self._lock:
+            self.calls[api] += 1
+            throttled = self._random.random() < self.throttle_rate
+            if throttled:
+                self.throttles[api] += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+        return throttled
+
+    def stats(self):
+        with self._lock:
+            return {'calls': dict(self.calls),
+                    'throttles': dict(self.throttles)}
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.throttles.clear()
+
+    def list_objects_v2(self, query):
+        prefix = query.get('prefix', '')
+        delimiter = query.get('delimiter')
+        max_keys = int(query.get('max-keys', 1000))
+        start = query.get('start-after', '')
+        if query.get('continuation-token'):
+            start = _decode_token(query['continuation-token'])
+
+        i = bisect.bisect_right(self.keys, start) if start else 0
+        i = max(i, bisect.bisect_left(self.keys, prefix))
+        contents, common_prefixes = [], []
+        last = None
+        while (i < len(self.keys) and
+               len(contents) + len(common_prefixes) < max_keys):
+            key = self.keys[i]
+            if not key.startswith(prefix):
+                break
+
+            pos = key.find(delimiter, len(prefix)) if delimiter else -1
+            if pos >= 0:
+                common_prefix = key[:pos + 1]
+                common_prefixes.append(common_prefix)
+                # Skip every key under the common prefix
+                last = common_prefix + '\x7f'
+                i = bisect.bisect_left(self.keys, last)
+                continue
+
+            contents.append(key)
+            last = key
+            i += 1
+
+        truncated = i < len(self.keys) and self.keys[i].startswith(prefix)
+        out = ['<?xml version="1.0" encoding="UTF-8"?>',
+               '<ListBucketResult xmlns="{}">'.format(S3_NS),
+               '<Name>bucket</Name><Prefix>{}</Prefix>'.format(escape(prefix)),
+               '<KeyCount>{}</KeyCount><MaxKeys>{}</MaxKeys>'.format(
+                   len(contents) + len(common_prefixes), max_keys),
+               '<IsTruncated>{}</IsTruncated>'.format(
+                   'true' if truncated else 'false')]
+        if truncated:
+            out.append('<NextContinuationToken>{}</NextContinuationToken>'
+                       .format(_encode_token(last)))
+        for key in contents:
+            out.append(
+                '<Contents><Key>{}</Key><LastModified>{}</LastModified>'
+                '<ETag>"d41d8cd98f00b204e9800998ecf8427e"</ETag>'
+                '<Size>{}</Size><StorageClass>STANDARD</StorageClass>'
+                '</Contents>'.format(
+                    escape(key), LAST_MODIFIED, len(key) * 1000))
+        for common_prefix in common_prefixes:
+            out.append('<CommonPrefixes><Prefix>{}</Prefix></CommonPrefixes>'
+                       .format(escape(common_prefix)))
+        out.append('</ListBucketResult>')
+        return ''.join(out)
+
+    def get_object(self, key, byte_range):
+        '''
+        :param byte_range: a Range header like bytes=0-3, or None
+        :return: status code and body of the object ``key``, None if there
+        is no such key
+        '''
+
+        i = bisect.bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            return None
+
+        size = len(key) * 1000
+        start, end = 0, size - 1
+        if byte_range:
+            first, _, last = byte_range.split('=', 1)[1].partition('-')
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        if zlib.crc32(key) % 1000 < self.plain_rate * 1000:
+            content = PLAIN_LINE
+        else:
+            content = GZIP_HEADER
+        # Content repeats, so any range can be cut from it
+        repeated = content * ((end + 1) // len(content) + 1)
+        return 206 if byte_range else 200, repeated[start:end + 1]
+
+    def list_metrics(self, params):
+        namespace = params.get('Namespace', 'AWS/EC2')
+        names = self.metrics
+        if params.get('MetricName'):
+            names = [n for n in names if n == params['MetricName']]
+
+        total = len(names) * self.dimensions
+        start = int(params.get('NextToken') or 0)
+        end = min(start + CLOUDWATCH_PAGE, total)
+        out = ['<ListMetricsResponse xmlns="{}"><ListMetricsResult>'
+               '<Metrics>'.format(CLOUDWATCH_NS)]
+        for i in xrange(start, end):
+            out.append(
+                '<member><Namespace>{}</Namespace><MetricName>{}</MetricName>'
+                '<Dimensions><member><Name>InstanceId</Name>'
+                '<Value>i-{:08x}</Value></member></Dimensions></member>'
+                .format(escape(namespace), names[i // self.dimensions],
+                        i % self.dimensions))
+        out.append('</Metrics>')
+        if end < total:
+            out.append('<NextToken>{}</NextToken>'.format(end))
+        out.append('</ListMetricsResult><ResponseMetadata><RequestId>1'
+                   '</RequestId></ResponseMetadata></ListMetricsResponse>')
+        return ''.join(out)
+
+    def kinesis(self, operation, params):
+        if operation == 'ListStreams':
+            limit = params.get('Limit', 10)
+            start = 0
+            if params.get('ExclusiveStartStreamName'):
+                start = bisect.bisect_right(
+                    self.streams, params['ExclusiveStartStreamName'])
+            return {'StreamNames': self.streams[start:start + limit],
+                    'HasMoreStreams': start + limit < len(self.streams)}
+
+        summary = {
+            'StreamName': params.get('StreamName'),
+            'StreamARN': 'arn:aws:kinesis:us-east-1:1:stream/{}'.format(
+                params.get('StreamName')),
+            'StreamStatus': 'ACTIVE',
+            'RetentionPeriodHours': 24,
+            'StreamCreationTimestamp': 1472731200,
+            'EnhancedMonitoring': [],
+            'OpenShardCount': self.shards,
+        }
+        if operation == 'DescribeStreamSummary':
+            return {'StreamDescriptionSummary': summary}
+
+        if operation == 'DescribeStream':
+            summary['Shards'] = self._shards(0, min(self.shards, 100))
+            summary['HasMoreShards'] = self.shards > 100
+            return {'StreamDescription': summary}
+
+        if operation == 'ListShards':
+            start = 0
+            if params.get('NextToken'):
+                start = int(_decode_token(params['NextToken']))
+            end = min(start + params.get('MaxResults', 1000), self.shards)
+            response = {'Shards': self._shards(start, end)}
+            if end < self.shards:
+                response['NextToken'] = _encode_token(str(end))
+            return response
+        return None
+
+    def _shards(self, start, end):
+        step = 2 ** 128 // max(self.shards, 1)
+        return [{
+            'ShardId': 'shardId-{:012d}'.format(i),
+            'HashKeyRange': {
+                'StartingHashKey': str(i * step),
+                'EndingHashKey': str((i + 1) * step - 1)},
+            'SequenceNumberRange': {
+                'StartingSequenceNumber': '4957{:052d}'.format(i)},
+        } for i in xrange(start, end)]
+
+
+class FakeAWSHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == '/__stats':
+            return self._send(200, 'application/json',
+                              json.dumps(self.server.fake.stats()))
+
+        query = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        if query.get('list-type') == '2':
+            if self.server.fake.count('s3.ListObjectsV2'):
+                return self._send(503, 'application/xml', (
+                    '<Error><Code>SlowDown</Code><Message>Please reduce '
+                    'your request rate.</Message></Error>'))
+            return self._send(200, 'application/xml',
+                              self.server.fake.list_objects_v2(query))
+        if '/' in url.path[1:]:
+            if self.server.fake.count('s3.GetObject'):
+                return self._send(503, 'application/xml', (
+                    '<Error><Code>SlowDown</Code><Message>Please reduce '
+                    'your request rate.</Message></Error>'))
+            key = urllib.unquote(url.path[1:].split('/', 1)[1])
+            response = self.server.fake.get_object(
+                key, self.headers.get('Range'))
+            if response is None:
+                return self._send(404, 'application/xml', (
+                    '<Error><Code>NoSuchKey</Code><Message>The specified '
+                    'key does not exist.</Message></Error>'))
+            return self._send(response[0], 'application/octet-stream',
+                              response[1])
+        return self._send(404, 'application/xml',
+                          '<Error><Code>NotImplemented</Code></Error>')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path == '/__reset':
+            self.server.fake.reset()
+            return self._send(200, 'application/json', '{}')
+
+        target = self.headers.get('X-Amz-Target')
+        if target:
+            operation = target.split('.')[-1]
+            if self.server.fake.count('kinesis.' + operation):
+                return self._send(400, 'application/x-amz-json-1.1', json.dumps(
+                    {'__type': 'LimitExceededException',
+                     'message': 'Rate exceeded'}))
+            response = self.server.fake.kinesis(operation, json.loads(body))
+            if response is None:
+                return self._send(400, 'application/x-amz-json-1.1', json.dumps(
+                    {'__type': 'UnknownOperationException'}))
+            return self._send(200, 'application/x-amz-json-1.1',
+                              json.dumps(response))
+
+        params = dict(urlparse.parse_qsl(body))
+        if params.get('Action') == 'ListMetrics':
+            if self.server.fake.count('cloudwatch.ListMetrics'):
+                return self._send(400, 'text/xml', (
+                    '<ErrorResponse><Error><Type>Sender</Type>'
+                    '<Code>Throttling</Code><Message>Rate exceeded</Message>'
+                    '</Error><RequestId>1</RequestId></ErrorResponse>'))
+            return self._send(200, 'text/xml',
+                              self.server.fake.list_metrics(params))
+        return self._send(400, 'text/xml', (
+            '<ErrorResponse><Error><Code>InvalidAction</Code></Error>'
+            '</ErrorResponse>'))
+
+    def _send(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('x-amz-request-id', '1')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeAWSServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, address, fake):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeAWSHandler)
+        self.fake = fake
+
+
+def add_params(parser):
+    parser.add_argument('--keys', type=int, default=200000)
+    parser.add_argument('--prefixes', type=int, default=16)
+    parser.add_argument('--skew', type=float, default=0.0,
+                        help='Fraction of keys under the first prefix')
+    parser.add_argument('--plain_rate', type=float, default=0.0,
+                        help='Fraction of S3 objects holding plain text '
+                             'instead of gzip')
+    parser.add_argument('--metrics', type=int, default=20)
+    parser.add_argument('--dimensions', type=int, default=500)
+    parser.add_argument('--streams', type=int, default=50)
+    parser.add_argument('--shards', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Seconds added to every call')
+    parser.add_argument('--throttle_rate', type=float, default=0.0,
+                        help='Fraction of calls answered with throttling')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=0)
+    add_params(parser)
+    args = parser.parse_args()
+
+    server = FakeAWSServer(('127.0.0.1', args.port), FakeAWS(args))
+    # The benchmark harness reads the port from the first line
+    print server.server_address[1]
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+'''
+Collection engines. "thread" runs the snappers on OS threads. "gevent"
+monkey-patches the standard library so the same threads become greenlets,
+which keep hundreds of requests in flight at little switching cost.
+
+Patching has to happen before anything imports socket or threading, so
+this module imports nothing at module level.
+'''
+
+ENGINES = ('thread', 'gevent')
+
+
+def requested_engine(argv):
+    '''
+    :return: the --engine given in the command line ``argv``, ahead of
+    argparse which runs after all imports
+    '''
+
+    for i, arg in enumerate(argv):
+        if arg == '--engine' and i + 1 < len(argv):
+            return argv[i + 1]
+        if arg.startswith('--engine='):
+            return arg.split('=', 1)[1]
+    return 'thread'
+
+
+def setup(engine):
+    if engine != 'gevent':
+        return
+
+    try:
+        from gevent import monkey
+    except ImportError:
+        raise Exception('The gevent engine requires the gevent package')
+    monkey.patch_all()
@@ -1,22 +1,572 @@
+import collections
+import gzip
 import json
+import logging
+import os
+import Queue
+import sqlite3
+import threading
+import time
+import traceback
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import utils
+
+
+# Large output buffer, so writing one record at a time stays cheap
+DEFAULT_BUFFER_SIZE = 4 * 1024 * 1024
+
+# "auto" picks the compression from the file name suffix
+COMPRESSIONS = ('auto', 'none', 'gzip', 'zstd')
+COMPRESSION_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
+
+# Target files with these suffixes are written as SQLite databases
+SQLITE_SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+
+# Records inserted per SQLite transaction
+SQLITE_COMMIT_RECORDS = 200000
+
+# One table per snap type. Fields of a record without a column of their
+# own, like Region tags, go to "extra" as JSON
+SQLITE_TABLES = (
+    '''CREATE TABLE IF NOT EXISTS s3_keys (
+        key TEXT, last_modified TEXT, size INTEGER, storage_class TEXT,
+        change_type TEXT, extra TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS s3_prefix_aggregates (
+        prefix TEXT, depth INTEGER, count INTEGER, size INTEGER,
+        oldest_last_modified TEXT, newest_last_modified TEXT, extra TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS cloudwatch_metrics (
+        id INTEGER PRIMARY KEY, namespace TEXT, metric_name TEXT,
+        extra TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS cloudwatch_dimensions (
+        metric_id INTEGER, name TEXT, value TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS kinesis_streams (
+        stream_name TEXT, stream_arn TEXT, stream_status TEXT,
+        stream_creation_timestamp TEXT, open_shard_count INTEGER,
+        extra TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS kinesis_shards (
+        stream_name TEXT, shard_id TEXT, parent_shard_id TEXT,
+        adjacent_parent_shard_id TEXT, starting_hash_key TEXT,
+        ending_hash_key TEXT, starting_sequence_number TEXT,
+        ending_sequence_number TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS records (record TEXT)''',
+)
+
+# Name, table and columns of the indexes, built once the load is done
+SQLITE_INDEXES = (
+    ('s3_keys_key', 's3_keys', 'key'),
+    ('s3_keys_last_modified', 's3_keys', 'last_modified'),
+    ('s3_prefix_aggregates_prefix', 's3_prefix_aggregates', 'prefix'),
+    ('cloudwatch_metrics_metric_name', 'cloudwatch_metrics', 'metric_name'),
+    ('cloudwatch_dimensions_metric_id', 'cloudwatch_dimensions',
+     'metric_id'),
+    ('cloudwatch_dimensions_name_value', 'cloudwatch_dimensions',
+     'name, value'),
+    ('kinesis_streams_stream_name', 'kinesis_streams', 'stream_name'),
+    ('kinesis_shards_stream_name', 'kinesis_shards', 'stream_name'),
+)
+
+SQLITE_INSERTS = {
+    's3_keys': 'INSERT INTO s3_keys VALUES (?, ?, ?, ?, ?, ?)',
+    's3_prefix_aggregates':
+        'INSERT INTO s3_prefix_aggregates VALUES (?, ?, ?, ?, ?, ?, ?)',
+    'cloudwatch_metrics': 'INSERT INTO cloudwatch_metrics VALUES (?, ?, ?, ?)',
+    'cloudwatch_dimensions':
+        'INSERT INTO cloudwatch_dimensions VALUES (?, ?, ?)',
+    'kinesis_streams':
+        'INSERT INTO kinesis_streams VALUES (?, ?, ?, ?, ?, ?)',
+    'kinesis_shards':
+        'INSERT INTO kinesis_shards VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+    'records': 'INSERT INTO records VALUES (?)',
+}
+
+_AGGREGATE_FIELDS = frozenset((
+    'Prefix', 'Depth', 'Count', 'Size', 'OldestLastModified',
+    'NewestLastModified'))
+_METRIC_FIELDS = frozenset(('Namespace', 'MetricName', 'Dimensions'))
+_STREAM_FIELDS = frozenset((
+    'StreamName', 'StreamARN', 'StreamStatus', 'StreamCreationTimestamp',
+    'OpenShardCount', 'Shards'))
+
+
+def guess_compression(fname):
+    for compression, suffix in COMPRESSION_SUFFIXES.iteritems():
+        if fname.endswith(suffix):
+            return compression
+    return 'none'
+
+
+class ZstdFile(object):
+    '''
+    Minimal writable zstd file, appending a new frame in append mode
+    '''
+
+    def __init__(self, fname, mode):
+        self._fileobj = open(fname, mode + 'b')
+        self._compressor = zstandard.ZstdCompressor(
+            level=ZSTD_LEVEL).compressobj()
+
+    def write(self, data):
+        self._fileobj.write(self._compressor.compress(data))
+
+    def flush(self):
+        self._fileobj.write(
+            self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK))
+        self._fileobj.flush()
+
+    def close(self):
+        self._fileobj.write(self._compressor.flush())
+        self._fileobj.close()
+
+
+class BackgroundFile(object):
+    '''
+    File like object which hands written data over in large chunks to a
+    thread doing compression and disk I/O, so the caller only pays for
+    serialization.
+    '''
+
+    def __init__(self, fileobj, chunk_size, max_pending_chunks=16):
+        self._fileobj = fileobj
+        self._chunk_size = chunk_size
+        self._chunks = []
+        self._size = 0
+        self._error = None
+        self._pending = Queue.Queue(max_pending_chunks)
+        self._thread = threading.Thread(target=self._drain)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._size >= self._chunk_size:
+            self._hand_over()
+
+    def flush(self):
+        '''
+        Wait until everything written so far reached the file
+        '''
+        self._hand_over()
+        self._pending.join()
+        self._fileobj.flush()
+        self._check_error()
+
+    def close(self):
+        self._hand_over()
+        self._pending.put(None)
+        self._thread.join()
+        self._fileobj.close()
+        self._check_error()
+
+    def _hand_over(self):
+        self._check_error()
+        if self._chunks:
+            self._pending.put(''.join(self._chunks))
+            self._chunks = []
+            self._size = 0
+
+    def _check_error(self):
+        if self._error is not None:
+            raise Exception(self._error)
+
+    def _drain(self):
+        while 1:
+            data = self._pending.get()
+            try:
+                if data is None:
+                    break
+
+                if self._error is None:
+                    self._fileobj.write(data)
+            except Exception:
+                self._error = 'Failed to write file, error={}'.format(
+                    traceback.format_exc())
+                logging.error(self._error)
+            finally:
+                self._pending.task_done()
 
 
 class JsonEventWriter(object):
+    '''
+    Streams records as newline delimited JSON, one record per line. Records
+    are dicts or objects serializing themselves through to_json().
+    '''
+
+    def __init__(self, fname, mode='w', buffer_size=DEFAULT_BUFFER_SIZE,
+                 compression='auto'):
+        if compression == 'auto':
+            compression = guess_compression(fname)
+        if compression == 'zstd' and zstandard is None:
+            raise Exception(
+                'zstd compression requires the zstandard package')
 
-    def __init__(self, fname, mode='w'):
         self.fname = fname
         self.mode = mode
+        self.buffer_size = buffer_size
+        self.compression = compression
         self.opened_file = None
+        self.bytes_written = 0
+        self.records_written = 0
 
     def __enter__(self):
-        self.opened_file = open(self.fname, self.mode)
+        self.opened_file = self._open()
         return self
 
     def __exit__(self, *args):
         self.opened_file.close()
+        self.opened_file = None
+        logging.warn(
+            'Wrote file=%s records=%d bytes=%d',
+            self.fname, self.records_written, self.bytes_written)
+
+    def flush(self):
+        self.opened_file.flush()
+
+    def checkpoint(self):
+        '''
+        Flush the records written so far. Compressed files end their gzip
+        member or zstd frame, so the file reads on its own up to here
+        :return: size of the file, a resumed snap truncates it to that
+        '''
+
+        if self.compression == 'none':
+            self.opened_file.flush()
+        else:
+            self.opened_file.close()
+            # The next member or frame follows in append mode
+            self.opened_file = self._open('a')
+        return os.path.getsize(self.fname)
+
+    def _open(self, mode=None):
+        mode = mode or self.mode
+        if self.compression == 'gzip':
+            fileobj = gzip.GzipFile(
+                self.fname, mode + 'b', compresslevel=GZIP_LEVEL)
+        elif self.compression == 'zstd':
+            fileobj = ZstdFile(self.fname, mode)
+        else:
+            return open(self.fname, mode, self.buffer_size)
+        return BackgroundFile(fileobj, self.buffer_size)
 
     def write(self, metas):
         assert self.opened_file
 
-        self.opened_file.write(
-            '\n'.join(json.dumps(meta) for meta in metas))
+        write = self.opened_file.write
+        num_bytes, num_records = 0, 0
+        dumps = json.dumps
+        for meta in metas:
+            if type(meta) is dict:
+                record = dumps(meta)
+            else:
+                record = meta.to_json()
+            write(record)
+            write('\n')
+            num_bytes += len(record) + 1
+            num_records += 1
+
+        self.bytes_written += num_bytes
+        self.records_written += num_records
+
+
+def _extra(record, fields):
+    extra = dict(
+        (name, value) for name, value in record.iteritems()
+        if name not in fields)
+    return json.dumps(extra) if extra else None
+
+
+class SqliteEventWriter(object):
+    '''
+    Loads records into a SQLite database, one table per snap type, for
+    queries like largest prefixes or keys modified since a date. Rows are
+    inserted with executemany() in transactions of SQLITE_COMMIT_RECORDS
+    records on a WAL journal, and the indexes are built once the writer is
+    closed, which loads far faster than maintaining them row by row.
+    Records are dicts, or objects naming their table in SQLITE_TABLE and
+    giving its columns through to_row() like KeyMeta.
+    '''
+
+    def __init__(self, fname, mode='w'):
+        self.fname = fname
+        self.mode = mode
+        self.conn = None
+        self.bytes_written = 0
+        self.records_written = 0
+        self._uncommitted = 0
+        self._next_metric_id = 0
+
+    def __enter__(self):
+        if self.mode == 'w':
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(self.fname + suffix):
+                    os.remove(self.fname + suffix)
+
+        # Shared writers are entered and written from different threads,
+        # callers serialize the access
+        self.conn = sqlite3.connect(
+            self.fname, isolation_level=None, check_same_thread=False)
+        self.conn.text_factory = str
+        # Larger pages and cache speed up bulk inserts and index builds,
+        # the page size only applies to new databases
+        self.conn.execute('PRAGMA page_size=16384')
+        self.conn.execute('PRAGMA cache_size=-65536')
+        self.conn.execute('PRAGMA temp_store=MEMORY')
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        for table in SQLITE_TABLES:
+            self.conn.execute(table)
+        # Appending loads without indexes too
+        for name, table, columns in SQLITE_INDEXES:
+            self.conn.execute('DROP INDEX IF EXISTS {}'.format(name))
+        self._next_metric_id = self.conn.execute(
+            'SELECT COALESCE(MAX(id), 0) + 1 FROM cloudwatch_metrics'
+        ).fetchone()[0]
+        self.conn.execute('BEGIN')
+        return self
+
+    def __exit__(self, *args):
+        self.conn.execute('COMMIT')
+        start = time.time()
+        for name, table, columns in SQLITE_INDEXES:
+            self.conn.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                name, table, columns))
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.conn.close()
+        self.conn = None
+        self.bytes_written = os.path.getsize(self.fname)
+        logging.warn(
+            'Wrote database=%s records=%d bytes=%d indexing took=%s seconds',
+            self.fname, self.records_written, self.bytes_written,
+            time.time() - start)
+
+    def flush(self):
+        self._commit()
+
+    def checkpoint(self):
+        '''
+        Commit the records written so far
+        :return: None, committed rows need no truncating on resume
+        '''
+        self._commit()
+        return None
+
+    def write(self, metas):
+        assert self.conn
+
+        rows = collections.defaultdict(list)
+        num_records = 0
+        for meta in metas:
+            if type(meta) is not dict:
+                rows[meta.SQLITE_TABLE].append(meta.to_row())
+            elif 'MetricName' in meta:
+                self._metric_rows(meta, rows)
+            elif 'StreamName' in meta:
+                self._stream_rows(meta, rows)
+            elif 'Prefix' in meta and 'Count' in meta:
+                rows['s3_prefix_aggregates'].append((
+                    meta['Prefix'], meta.get('Depth'), meta['Count'],
+                    meta.get('Size'), meta.get('OldestLastModified'),
+                    meta.get('NewestLastModified'),
+                    _extra(meta, _AGGREGATE_FIELDS)))
+            else:
+                rows['records'].append((json.dumps(meta),))
+            num_records += 1
+
+        for table, table_rows in rows.iteritems():
+            self.conn.executemany(SQLITE_INSERTS[table], table_rows)
+
+        self.records_written += num_records
+        self._uncommitted += num_records
+        if self._uncommitted >= SQLITE_COMMIT_RECORDS:
+            self._commit()
+
+    def _metric_rows(self, metric, rows):
+        metric_id = self._next_metric_id
+        self._next_metric_id += 1
+        rows['cloudwatch_metrics'].append((
+            metric_id, metric.get('Namespace'), metric['MetricName'],
+            _extra(metric, _METRIC_FIELDS)))
+        for dimension in metric.get('Dimensions') or ():
+            rows['cloudwatch_dimensions'].append(
+                (metric_id, dimension.get('Name'), dimension.get('Value')))
+
+    def _stream_rows(self, stream, rows):
+        stream_name = stream['StreamName']
+        rows['kinesis_streams'].append((
+            stream_name, stream.get('StreamARN'), stream.get('StreamStatus'),
+            stream.get('StreamCreationTimestamp'),
+            stream.get('OpenShardCount'), _extra(stream, _STREAM_FIELDS)))
+        for shard in stream.get('Shards') or ():
+            hash_keys = shard.get('HashKeyRange') or {}
+            sequence_numbers = shard.get('SequenceNumberRange') or {}
+            rows['kinesis_shards'].append((
+                stream_name, shard.get('ShardId'),
+                shard.get('ParentShardId'),
+                shard.get('AdjacentParentShardId'),
+                hash_keys.get('StartingHashKey'),
+                hash_keys.get('EndingHashKey'),
+                sequence_numbers.get('StartingSequenceNumber'),
+                sequence_numbers.get('EndingSequenceNumber')))
+
+    def _commit(self):
+        self.conn.execute('COMMIT')
+        self.conn.execute('BEGIN')
+        self._uncommitted = 0
+        self.bytes_written = os.path.getsize(self.fname)
+        if os.path.exists(self.fname + '-wal'):
+            self.bytes_written += os.path.getsize(self.fname + '-wal')
+
+
+def is_sqlite(fname):
+    return fname.endswith(SQLITE_SUFFIXES)
+
+
+def new_writer(fname, mode='w', buffer_size=DEFAULT_BUFFER_SIZE,
+               compression='auto'):
+    '''
+    :return: a SqliteEventWriter for SQLITE_SUFFIXES target files, else a
+    JsonEventWriter
+    '''
+
+    if is_sqlite(fname):
+        return SqliteEventWriter(fname, mode)
+    return JsonEventWriter(fname, mode, buffer_size, compression)
+
+
+class SharedEventWriter(object):
+    '''
+    Lets snaps running concurrently or one after another write into one
+    underlying writer. The file is opened by the first __enter__ and stays
+    open until close(), and writes are serialized. Records of each snap can
+    be tagged with extra fields through tagged().
+    '''
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.fname = writer.fname
+        self._opened = False
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with self._lock:
+            if not self._opened:
+                self.writer.__enter__()
+                self._opened = True
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def close(self):
+        with self._lock:
+            if self._opened:
+                self.writer.__exit__(None, None, None)
+                self._opened = False
+
+    def flush(self):
+        with self._lock:
+            self.writer.flush()
+
+    def write(self, metas):
+        with self._lock:
+            self.writer.write(metas)
+
+    def tagged(self, tags):
+        return TaggedEventWriter(self, tags)
+
+
+class TaggedEventWriter(object):
+    '''
+    Adds ``tags`` fields to every record before writing it to ``writer``
+    '''
+
+    def __init__(self, writer, tags):
+        self.writer = writer
+        self.fname = writer.fname
+        self.tags = tags
+
+    def __enter__(self):
+        self.writer.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.writer.__exit__(*args)
+
+    def flush(self):
+        self.writer.flush()
+
+    def write(self, metas):
+        tagged = []
+        for meta in metas:
+            meta.update(self.tags)
+            tagged.append(meta)
+        self.writer.write(tagged)
+
+
+def _iter_chunks(fname, chunk_size=DEFAULT_BUFFER_SIZE):
+    with open(fname, 'rb') as f:
+        magic = f.read(4)
+        f.seek(0)
+
+        if utils.is_likely_gzip(magic):
+            f = gzip.GzipFile(fileobj=f)
+        elif magic == ZSTD_MAGIC:
+            if zstandard is None:
+                raise Exception(
+                    'Reading {} requires the zstandard package'.format(fname))
+            dctx = zstandard.ZstdDecompressor()
+            try:
+                # Appended files hold one frame per writer session
+                f = dctx.stream_reader(f, read_across_frames=True)
+            except TypeError:
+                # Older zstandard only reads the first frame
+                for chunk in dctx.read_to_iter(f, read_size=chunk_size):
+                    yield chunk
+                return
+
+        while 1:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def iter_events(fname):
+    '''
+    Read back records written by JsonEventWriter, detecting gzip/zstd
+    compression from the file content.
+    '''
+
+    tail = ''
+    for chunk in _iter_chunks(fname):
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            if line:
+                yield json.loads(line)
+
+    if tail.strip():
+        yield json.loads(tail)
+
+
+def count_events(fname):
+    '''
+    Count records written by JsonEventWriter without parsing them
+    '''
+
+    count = 0
+    last = '\n'
+    for chunk in _iter_chunks(fname):
+        count += chunk.count('\n')
+        last = chunk[-1]
+    # The last record may lack its newline
+    return count if last == '\n' else count + 1
@@ -0,0 +1,205 @@
+import logging
+import threading
+import time
+
+
+# Fraction of max_rate added per successful call / rate factor on throttle
+ADDITIVE_INCREASE = 0.01
+MULTIPLICATIVE_DECREASE = 0.5
+
+THROTTLE_ERROR_CODES = (
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'LimitExceededException',
+    'RequestLimitExceeded',
+    'SlowDown',
+)
+
+# Calls per second per account and region: (service, API) or service wide
+DEFAULT_RATES = {
+    's3': 1000,
+    ('s3', 'GetObject'): 5000,
+    'cloudwatch': 25,
+    'ec2': 20,
+    'kinesis': 20,
+    ('kinesis', 'ListStreams'): 5,
+    ('kinesis', 'DescribeStreamSummary'): 20,
+    ('kinesis', 'ListShards'): 100,
+}
+
+
+class TokenBucket(object):
+    '''
+    Thread safe token bucket allowing ``rate`` calls per second on average
+    and bursts of up to ``burst`` calls.
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Block until a call is allowed
+        :return: seconds waited
+        '''
+
+        waited = 0.0
+        while 1:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    '''
+    Token bucket which adapts its rate AIMD style: halved (at most once a
+    second) when the service throttles, raised a little with every
+    successful call, never above ``max_rate``. It also accounts time spent
+    waiting for tokens versus time spent in calls.
+    '''
+
+    def __init__(self, max_rate, min_rate=0.5):
+        TokenBucket.__init__(self, max_rate)
+        self.max_rate = float(max_rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.calls = 0
+        self.throttles = 0
+        self.wait_time = 0.0
+        self.work_time = 0.0
+        self._last_decrease = 0
+
+    def acquire(self):
+        waited = TokenBucket.acquire(self)
+        with self._lock:
+            self.calls += 1
+            self.wait_time += waited
+        return waited
+
+    def on_success(self, took):
+        with self._lock:
+            self.work_time += took
+            if self.rate < self.max_rate:
+                self._set_rate(
+                    self.rate + self.max_rate * ADDITIVE_INCREASE)
+
+    def on_throttle(self, took):
+        with self._lock:
+            self.work_time += took
+            self.throttles += 1
+            now = time.time()
+            if now - self._last_decrease >= 1:
+                self._last_decrease = now
+                self._set_rate(self.rate * MULTIPLICATIVE_DECREASE)
+
+    def _set_rate(self, rate):
+        self.rate = max(self.min_rate, min(self.max_rate, rate))
+        self.burst = max(1.0, self.rate)
+        self._tokens = min(self._tokens, self.burst)
+
+
+def parse_rates(rate_specs):
+    '''
+    :param rate_specs: a list like ["s3=500", "kinesis.ListShards=50"]
+    :return: a dict like DEFAULT_RATES
+    '''
+
+    rates = {}
+    for spec in rate_specs or []:
+        name, rate = spec.split('=', 1)
+        if '.' in name:
+            name = tuple(name.split('.', 1))
+        rates[name] = float(rate)
+    return rates
+
+
+class RateLimiters(object):
+    '''
+    One AdaptiveRateLimiter per service, region and API shared by all
+    snappers. Attached to botocore clients through their event hooks, so
+    every HTTP request, botocore retries included, waits for a token and
+    throttle responses slow down all threads calling the same API.
+    '''
+
+    def __init__(self, rates=None):
+        self.rates = dict(DEFAULT_RATES)
+        self.rates.update(rates or {})
+        self._limiters = {}
+        self._lock = threading.Lock()
+        self._call = threading.local()
+
+    def get(self, service_name, region_name, api):
+        key = (service_name, region_name, api)
+        limiter = self._limiters.get(key)
+        if limiter is not None:
+            return limiter
+
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                rate = self.rates.get(
+                    (service_name, api), self.rates.get(service_name))
+                if rate is None:
+                    return None
+                limiter = AdaptiveRateLimiter(rate)
+                self._limiters[key] = limiter
+        return limiter
+
+    def attach(self, client, service_name, region_name):
+        def before_call(model, **kwargs):
+            self._call.limiter = self.get(
+                service_name, region_name, model.name)
+
+        def before_send(**kwargs):
+            # Once per attempt, so throttled retries wait for a token too
+            limiter = getattr(self._call, 'limiter', None)
+            if limiter is not None:
+                limiter.acquire()
+            self._call.start = time.time()
+            # botocore takes a non None result for the HTTP response
+            return None
+
+        def needs_retry(operation, response=None, **kwargs):
+            limiter = self.get(service_name, region_name, operation.name)
+            if limiter is None:
+                return None
+
+            took = time.time() - getattr(self._call, 'start', time.time())
+            error_code = None
+            if response is not None:
+                error_code = response[1].get('Error', {}).get('Code')
+            if error_code in THROTTLE_ERROR_CODES:
+                limiter.on_throttle(took)
+            else:
+                limiter.on_success(took)
+            # Leave the retry decision to botocore
+            return None
+
+        client.meta.events.register('before-call', before_call)
+        client.meta.events.register('before-send', before_send)
+        client.meta.events.register('needs-retry', needs_retry)
+
+    def report(self):
+        for key, limiter in sorted(self._limiters.iteritems()):
+            logging.warn(
+                'Rate limiter service=%s region=%s api=%s calls=%d '
+                'throttles=%d rate=%.1f waited=%.1f seconds worked=%.1f '
+                'seconds',
+                key[0], key[1], key[2], limiter.calls, limiter.throttles,
+                limiter.rate, limiter.wait_time, limiter.work_time)
@@ -0,0 +1,40 @@
+import collections
+import threading
+
+
+class RecordQueue(object):
+    '''
+    FIFO queue of record batches bounded by the number of records queued
+    rather than by the number of batches, so the memory held between
+    collectors and the writer stays bounded whatever the batch sizes are.
+    A batch larger than the bound is still let in on an empty queue.
+    '''
+
+    def __init__(self, max_records):
+        self.maxsize = max_records
+        self._items = collections.deque()
+        self._records = 0
+        self._cond = threading.Condition()
+
+    def put(self, item, num_records=0):
+        with self._cond:
+            while self._items and self._records + num_records > self.maxsize:
+                self._cond.wait()
+            self._items.append((item, num_records))
+            self._records += num_records
+            self._cond.notify_all()
+
+    def get(self):
+        with self._cond:
+            while not self._items:
+                self._cond.wait()
+            item, num_records = self._items.popleft()
+            self._records -= num_records
+            self._cond.notify_all()
+            return item
+
+    def qsize(self):
+        '''
+        :return: number of records queued
+        '''
+        return self._records
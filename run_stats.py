@@ -0,0 +1,362 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+import rate_limiter
+
+
+# Upper bounds of the latency histogram buckets in milliseconds
+LATENCY_BUCKETS_MS = (
+    5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+# Seconds between samples of watched queues and writers
+SAMPLE_INTERVAL = 1.0
+
+
+class ApiStats(object):
+    '''
+    Counters of one service/region/API. Calls count API calls made by the
+    snappers, attempts count HTTP requests including botocore retries.
+    Latency spans sending a request up to its parsed response.
+    '''
+
+    def __init__(self):
+        self.calls = 0
+        self.attempts = 0
+        self.retries = 0
+        self.throttles = 0
+        self.errors = 0
+        self.bytes_received = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_hist = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Sent from worker processes to the parent
+        with self._lock:
+            state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add_call(self):
+        with self._lock:
+            self.calls += 1
+
+    def merge(self, other):
+        with self._lock:
+            self.calls += other.calls
+            self.attempts += other.attempts
+            self.retries += other.retries
+            self.throttles += other.throttles
+            self.errors += other.errors
+            self.bytes_received += other.bytes_received
+            self.latency_total += other.latency_total
+            self.latency_max = max(self.latency_max, other.latency_max)
+            for i, count in enumerate(other.latency_hist):
+                self.latency_hist[i] += count
+
+    def add_attempt(self, latency, num_bytes, error_code, retry):
+        with self._lock:
+            self.attempts += 1
+            self.retries += retry
+            self.bytes_received += num_bytes
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+            self.latency_hist[bisect.bisect_left(
+                LATENCY_BUCKETS_MS, latency * 1000)] += 1
+            if error_code in rate_limiter.THROTTLE_ERROR_CODES:
+                self.throttles += 1
+            elif error_code is not None:
+                self.errors += 1
+
+    def percentile(self, fraction):
+        '''
+        :return: upper bound in milliseconds of the histogram bucket holding
+        the ``fraction`` percentile, None above the last bucket
+        '''
+
+        rank = fraction * self.attempts
+        seen = 0
+        for i, count in enumerate(self.latency_hist):
+            seen += count
+            if count and seen >= rank:
+                return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) \
+                    else None
+        return 0
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'attempts': self.attempts,
+                'retries': self.retries,
+                'throttles': self.throttles,
+                'errors': self.errors,
+                'bytes_received': self.bytes_received,
+                'latency_avg_ms': (
+                    self.latency_total * 1000 / self.attempts
+                    if self.attempts else 0),
+                'latency_max_ms': self.latency_max * 1000,
+                'latency_p50_ms': self.percentile(0.5),
+                'latency_p99_ms': self.percentile(0.99),
+                # Counts per LATENCY_BUCKETS_MS bucket, the last one above
+                'latency_hist': list(self.latency_hist),
+            }
+
+
+class QueueStats(object):
+    '''
+    Depth of a queue sampled every SAMPLE_INTERVAL
+    '''
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.samples = 0
+        self.depth = 0
+        self.depth_total = 0
+        self.depth_max = 0
+
+    def sample(self):
+        self.depth = self.queue.qsize()
+        self.samples += 1
+        self.depth_total += self.depth
+        self.depth_max = max(self.depth_max, self.depth)
+
+    def to_dict(self):
+        return {
+            'depth': self.depth,
+            'depth_avg': (
+                float(self.depth_total) / self.samples if self.samples else 0),
+            'depth_max': self.depth_max,
+            'maxsize': self.queue.maxsize,
+        }
+
+
+class WriterStats(object):
+    '''
+    Throughput of an event writer from its records/bytes counters
+    '''
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.start = time.time()
+        self._last = (self.start, 0, 0)
+        self.records_per_sec = 0.0
+        self.bytes_per_sec = 0.0
+
+    def sample(self):
+        now = time.time()
+        records, num_bytes = self.writer.records_written, \
+            self.writer.bytes_written
+        last_time, last_records, last_bytes = self._last
+        if now > last_time:
+            self.records_per_sec = (records - last_records) / (now - last_time)
+            self.bytes_per_sec = (num_bytes - last_bytes) / (now - last_time)
+        self._last = (now, records, num_bytes)
+
+    def to_dict(self):
+        took = time.time() - self.start
+        records = self.writer.records_written
+        num_bytes = self.writer.bytes_written
+        return {
+            'records': records,
+            'bytes': num_bytes,
+            'records_per_sec': records / took if took else 0,
+            'bytes_per_sec': num_bytes / took if took else 0,
+            'recent_records_per_sec': self.records_per_sec,
+            'recent_bytes_per_sec': self.bytes_per_sec,
+        }
+
+
+class RunStats(object):
+    '''
+    Per API call counts, latency histograms, retries, throttles and bytes
+    received, collected through the botocore event hooks of every client,
+    plus sampled depths of the snappers' result queues and writer
+    throughput. Written as JSON to ``fname`` at close() and, with
+    ``interval``, every ``interval`` seconds while running. Worker
+    processes keep RunStats of their own and send process_state() to the
+    parent, which folds them in through add_process().
+    '''
+
+    def __init__(self, fname=None, interval=0):
+        self.fname = fname
+        self.interval = interval
+        self.start = time.time()
+        self._apis = {}
+        self._queues = {}
+        self._writers = {}
+        # Latest process_state() per worker process
+        self._processes = {}
+        self._lock = threading.Lock()
+        self._call = threading.local()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def api(self, service_name, region_name, api):
+        key = (service_name, region_name, api)
+        stats = self._apis.get(key)
+        if stats is None:
+            with self._lock:
+                stats = self._apis.setdefault(key, ApiStats())
+        return stats
+
+    def attach(self, client, service_name, region_name):
+        def before_call(model, **kwargs):
+            self._call.stats = self.api(service_name, region_name, model.name)
+            self._call.attempts = 0
+            self._call.stats.add_call()
+
+        def before_send(**kwargs):
+            self._call.attempts = getattr(self._call, 'attempts', 0) + 1
+            self._call.start = time.time()
+            # botocore takes a non None result for the HTTP response
+            return None
+
+        def response_received(response_dict=None, parsed_response=None,
+                              exception=None, **kwargs):
+            stats = getattr(self._call, 'stats', None)
+            if stats is None:
+                return
+
+            latency = time.time() - self._call.start
+            num_bytes, error_code = 0, None
+            if response_dict is not None:
+                body = response_dict.get('body')
+                if isinstance(body, str):
+                    num_bytes = len(body)
+                else:
+                    num_bytes = int(response_dict.get('headers', {}).get(
+                        'content-length', 0))
+            if parsed_response is not None:
+                error_code = parsed_response.get('Error', {}).get('Code')
+            elif exception is not None:
+                error_code = type(exception).__name__
+            stats.add_attempt(
+                latency, num_bytes, error_code, self._call.attempts > 1)
+
+        self._start_sampling()
+        client.meta.events.register('before-call', before_call)
+        client.meta.events.register('before-send', before_send)
+        client.meta.events.register('response-received', response_received)
+
+    def watch_queue(self, name, queue):
+        with self._lock:
+            self._queues[name] = QueueStats(queue)
+        self._start_sampling()
+
+    def watch_writer(self, name, writer):
+        with self._lock:
+            self._writers[name] = WriterStats(writer)
+        self._start_sampling()
+
+    def process_state(self):
+        '''
+        :return: picklable API stats and queue/writer dicts of a worker
+        process for add_process() of the parent
+        '''
+
+        with self._lock:
+            apis = dict(self._apis)
+            queues = self._queues.items()
+            writers = self._writers.items()
+
+        return {
+            'apis': apis,
+            'queues': dict(
+                (name, stats.to_dict()) for name, stats in queues),
+            'writers': dict(
+                (name, stats.to_dict()) for name, stats in writers),
+        }
+
+    def add_process(self, name, state):
+        with self._lock:
+            self._processes[name] = state
+
+    def snapshot(self):
+        with self._lock:
+            apis = dict(self._apis)
+            queues = dict(
+                (name, stats.to_dict())
+                for name, stats in self._queues.iteritems())
+            writers = dict(
+                (name, stats.to_dict())
+                for name, stats in self._writers.iteritems())
+            processes = self._processes.values()
+
+        for state in processes:
+            for key, stats in state['apis'].iteritems():
+                merged = ApiStats()
+                if key in apis:
+                    merged.merge(apis[key])
+                merged.merge(stats)
+                apis[key] = merged
+            queues.update(state['queues'])
+            writers.update(state['writers'])
+        apis = sorted(apis.iteritems())
+
+        return {
+            'time': time.time(),
+            'latency_buckets_ms': LATENCY_BUCKETS_MS,
+            'took': time.time() - self.start,
+            'apis': [
+                dict(stats.to_dict(), service=key[0], region=key[1],
+                     api=key[2])
+                for key, stats in apis],
+            'queues': queues,
+            'writers': writers,
+        }
+
+    def save(self):
+        if not self.fname:
+            return
+
+        tmp_fname = self.fname + '.tmp'
+        with open(tmp_fname, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+        os.rename(tmp_fname, self.fname)
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._sample()
+        self.save()
+        if self.fname:
+            logging.warn('Wrote run stats file=%s', self.fname)
+
+    def _start_sampling(self):
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _sample(self):
+        with self._lock:
+            samplers = self._queues.values() + self._writers.values()
+        for sampler in samplers:
+            sampler.sample()
+
+    def _run(self):
+        last_save = time.time()
+        while not self._stopped.wait(SAMPLE_INTERVAL):
+            self._sample()
+            if self.interval and time.time() - last_save >= self.interval:
+                last_save = time.time()
+                try:
+                    self.save()
+                except Exception:
+                    logging.exception(
+                        'Failed to save run stats file=%s', self.fname)
@@ -1,10 +1,11 @@
-import boto3
+import collections
+import json
 import logging
 import re
 import os
 import time
-import traceback
 import threading
+import traceback
 import Queue
 import cloudwatch_defaults
 
@@ -52,22 +53,205 @@ class DimensionExactMatcher():
         return True
 
 
+def _anchored(regex_str):
+    if not regex_str.endswith('$'):
+        regex_str = regex_str + '$'
+    return '(?:{})'.format(regex_str)
+
+
+def _all_of(regex_strs):
+    '''
+    :return: one pattern matching what all of ``regex_strs`` match
+    '''
+    patterns = [_anchored(regex_str) for regex_str in regex_strs]
+    return ''.join('(?={})'.format(p) for p in patterns[:-1]) + patterns[-1]
+
+
+def _merge_rows(rows):
+    '''
+    Rows are alternatives, each a tuple of patterns ANDed per dimension.
+    Rows which only differ in one dimension are merged into a single row
+    with an alternation for that dimension.
+    '''
+
+    for col in xrange(len(rows[0]) if rows else 0):
+        merged = collections.OrderedDict()
+        for row in rows:
+            rest = row[:col] + row[col + 1:]
+            alternatives = merged.setdefault(rest, [])
+            if row[col] not in alternatives:
+                alternatives.append(row[col])
+
+        rows = []
+        for rest, alternatives in merged.iteritems():
+            if len(alternatives) == 1:
+                pattern = alternatives[0]
+            else:
+                pattern = '(?:{})'.format('|'.join(alternatives))
+            rows.append(rest[:col] + (pattern,) + rest[col:])
+    return rows
+
+
+class DimensionFilterIndex(object):
+    '''
+    Dimension filters compiled for matching many metrics. Like
+    DimensionExactMatcher a filter maps dimension names to one or more
+    regexes which must all fully match, and a metric has to have exactly
+    those dimensions. Filters are indexed by their set of dimension names
+    and merged where possible, so a metric takes one dict lookup and a few
+    regex matches whatever the number of filters.
+    '''
+
+    def __init__(self, re_value_dicts):
+        groups = collections.defaultdict(list)
+        for re_value_dict in re_value_dicts:
+            names = tuple(sorted(re_value_dict))
+            row = []
+            for name in names:
+                regex_strs = re_value_dict[name]
+                if not isinstance(regex_strs, list):
+                    regex_strs = [regex_strs]
+                row.append(_all_of(regex_strs))
+            groups[names].append(tuple(row))
+
+        self._index = {}
+        for names, rows in groups.iteritems():
+            compiled = [tuple(re.compile(pattern) for pattern in row)
+                        for row in _merge_rows(rows)]
+            self._index[frozenset(names)] = (names, compiled)
+
+    def match(self, dimensions):
+        values = {}
+        for dim in dimensions:
+            values[dim['Name']] = dim['Value']
+
+        entry = self._index.get(frozenset(values))
+        if entry is None:
+            return False
+
+        names, rows = entry
+        values = [values[name] for name in names]
+        for row in rows:
+            for regex, value in zip(row, values):
+                if isinstance(value, list):
+                    if not any(regex.match(v) for v in value):
+                        break
+                elif not regex.match(value):
+                    break
+            else:
+                return True
+        return False
+
+
 def get_dimension_filters(dimension_re_list):
+    '''
+    :param dimension_re_list: a dict or a list of dicts mapping dimension
+    names to regexes, or its JSON
+    :return: a DimensionFilterIndex or None if there are no filters
+    '''
+
     if not dimension_re_list:
-        return []
+        return None
+
+    if isinstance(dimension_re_list, basestring):
+        dimension_re_list = json.loads(dimension_re_list)
 
     if not isinstance(dimension_re_list, list):
         dimension_re_list = [dimension_re_list]
 
-    return [DimensionExactMatcher(re_value_dict)
-            for re_value_dict in dimension_re_list]
+    return DimensionFilterIndex(dimension_re_list)
+
+
+class ResourceIdCache(object):
+    '''
+    Sets of existing resource ids (EC2 instances, EBS volumes, ...) loaded
+    once per run and shared by all metric threads. Concurrent callers of
+    get() wait for the single caller doing the load. When ``fname`` is set,
+    loaded sets are persisted there and reused while younger than ``ttl``
+    seconds.
+    '''
+
+    def __init__(self, fname=None, ttl=0):
+        self.fname = fname
+        self.ttl = ttl
+        self._ids = {}
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        with self._lock:
+            if key in self._ids:
+                return self._ids[key]
+
+            loaded = self._loading.get(key)
+            if loaded is None:
+                self._loading[key] = threading.Event()
+
+        if loaded is not None:
+            loaded.wait()
+            with self._lock:
+                if key not in self._ids:
+                    raise Exception(
+                        'Failed to load resource ids for {}'.format(key))
+                return self._ids[key]
+
+        try:
+            ids = self._load_persisted(key)
+            if ids is None:
+                ids = loader()
+                self._persist(key, ids)
+            with self._lock:
+                self._ids[key] = ids
+        finally:
+            with self._lock:
+                loaded = self._loading.pop(key)
+            loaded.set()
+        return ids
+
+    def _read(self):
+        if not self.fname or not os.path.exists(self.fname):
+            return {}
+
+        try:
+            with open(self.fname) as f:
+                return json.load(f)
+        except Exception:
+            logging.warn(
+                'Ignore unreadable resource id cache=%s error=%s',
+                self.fname, traceback.format_exc())
+            return {}
+
+    def _load_persisted(self, key):
+        entry = self._read().get(key)
+        if entry and time.time() - entry['time'] < self.ttl:
+            return set(entry['ids'])
+        return None
+
+    def _persist(self, key, ids):
+        if not self.fname:
+            return
+
+        with self._lock:
+            cached = self._read()
+            cached[key] = {'time': time.time(), 'ids': sorted(ids)}
+            tmp_fname = self.fname + '.tmp'
+            with open(tmp_fname, 'w') as f:
+                json.dump(cached, f)
+            os.rename(tmp_fname, self.fname)
+
+
+def _filter_enabled():
+    return os.environ.get('cloudwatch_filter') in ('1', 'true', 'yes')
 
 
 class CloudWatchSnap(object):
 
-    def __init__(self, awscontext, namespace, metric_names, dimension_regs):
+    def __init__(self, awscontext, namespace, metric_names, dimension_regs,
+                 single_pass=False, resource_cache=None):
         self.ctx = awscontext
         self.namespace = namespace
+        self.single_pass = single_pass
+        self.resource_cache = resource_cache or ResourceIdCache()
         self.metric_names = self._get_metric_names(metric_names)
         self.dimension_filters = get_dimension_filters(dimension_regs)
         self.common_log = 'region={} namespace={} metrics={}'.format(
@@ -89,16 +273,20 @@ class CloudWatchSnap(object):
                 'End of collecting meta data for %s discoverd=%d '
                 'took=%s seconds',
                 self.common_log, metric_num, time.time() - start)
+            return metric_num
 
     def _do_snap(self):
-        # Collect
-        workers = []
+        if self.single_pass:
+            return self._do_snap_single_pass()
+
+        # Collect on the shared pool bounded by concurrency
         results_q = Queue.Queue(10000)
+        self.ctx.stats.watch_queue(
+            'cloudwatch:{}:{}:results_q'.format(
+                self.ctx.region, self.namespace), results_q)
         for metric_name in self.metric_names:
-            worker = threading.Thread(
-                target=self._collect_metric_meta, args=(metric_name, results_q))
-            worker.start()
-            workers.append(worker)
+            self.ctx.pool.submit(
+                self._collect_metric_meta, metric_name, results_q)
 
         # Index
         worker_done = 0
@@ -111,20 +299,46 @@ class CloudWatchSnap(object):
                     writer.write(dim_metrics)
                 else:
                     worker_done += 1
-                    if worker_done == len(workers):
+                    if worker_done == len(self.metric_names):
                         break
 
-        for worker in workers:
-            worker.join()
-
         return metric_num
 
+    def _do_snap_single_pass(self):
+        '''
+        Page through the whole namespace once instead of once per metric
+        name, then bucket the metrics by name locally
+        '''
+
+        start = time.time()
+        wanted = set(self.metric_names)
+        metrics = [metric for metric in self._list_metrics_by_metric_name(None)
+                   if metric['MetricName'] in wanted]
+        if _filter_enabled():
+            metrics = self._filter_invalid_dimensions(metrics)
+
+        by_metric_name = collections.defaultdict(list)
+        for metric in metrics:
+            by_metric_name[metric['MetricName']].append(metric)
+
+        with self.ctx.eventwriter as writer:
+            for metric_name in self.metric_names:
+                dim_metrics = by_metric_name.get(metric_name, [])
+                writer.write(dim_metrics)
+                logging.warn(
+                    'List metric for region=%s namespace=%s metric_name=%s, '
+                    'discovered=%s took=%s',
+                    self.ctx.region, self.namespace, metric_name,
+                    len(dim_metrics), time.time() - start)
+
+        return len(metrics)
+
     def _collect_metric_meta(self, metric_name, results_q):
         start = time.time()
 
         try:
             metrics = self._list_metrics_by_metric_name(metric_name)
-            if os.environ.get('cloudwatch_filter') in ('1', 'true', 'yes'):
+            if _filter_enabled():
                 metrics = self._filter_invalid_dimensions(metrics)
             results_q.put(metrics)
         except Exception:
@@ -143,11 +357,7 @@ class CloudWatchSnap(object):
         results_q.put(None)
 
     def _list_metrics_by_metric_name(self, metric_name):
-        client = boto3.client(
-            'cloudwatch',
-            region_name=self.ctx.region,
-            aws_access_key_id=self.ctx.access_key,
-            aws_secret_access_key=self.ctx.secret_key)
+        client = self.ctx.client('cloudwatch')
 
         all_metrics = []
         params = {
@@ -181,13 +391,9 @@ class CloudWatchSnap(object):
         return all_metrics
 
     def _match_dimension(self, metric):
-        if not self.dimension_filters:
+        if self.dimension_filters is None:
             return True
-
-        for matcher in self.dimension_regex_filters:
-            if matcher.exact_match(metric['Dimensions']):
-                return True
-        return False
+        return self.dimension_filters.match(metric['Dimensions'])
 
     def _filter_invalid_dimensions(self, metrics):
         # For now we only care EC2/EBS
@@ -199,12 +405,7 @@ class CloudWatchSnap(object):
         if self.namespace not in filter_map:
             return metrics
 
-        client = boto3.client(
-            filter_map[self.namespace]['service'],
-            region_name=self.ctx.region,
-            aws_access_key_id=self.ctx.access_key,
-            aws_secret_access_key=self.ctx.secret_key,
-        )
+        client = self.ctx.client(filter_map[self.namespace]['service'])
 
         return filter_map[self.namespace]['func'](client, metrics)
 
@@ -226,9 +427,13 @@ class CloudWatchSnap(object):
 
     def _do_filter_invalid_dimensions(
             self, describe_func, result_key, instance_key, id_key, metrics):
+        # Every metric thread needs the same ids, crawl them once
+        cache_key = '{}:{}'.format(self.ctx.region, describe_func.__name__)
         try:
-            exists = self._get_valid_dimensions(
-                describe_func, result_key, instance_key, id_key)
+            exists = self.resource_cache.get(
+                cache_key,
+                lambda: self._get_valid_dimensions(
+                    describe_func, result_key, instance_key, id_key))
         except Exception:
             logging.error(
                 'Failed to get valid dimensions for %s, error=%s',
@@ -312,9 +517,29 @@ def add_params(subparsers):
         help='CloudWatch metrics like CPUCreditBalance,CPUCreditUsage')
     cloudwatch_parser.add_argument(
         '--dimension_filter', dest='dim_filter_rex', default='',
-        help='CloudWatch dimension filter')
+        help='CloudWatch dimension filter, JSON dict or list of dicts '
+             'mapping dimension names to regexes like '
+             '{"InstanceId": "i-(0|1).*"}. Metrics matching any of the '
+             'dicts are kept. A list of regexes for one dimension is ANDed, '
+             'all of them have to match')
+    cloudwatch_parser.add_argument(
+        '--single_pass', dest='single_pass', action='store_true',
+        default=False,
+        help='List the whole namespace once and group metrics by name '
+             'locally, instead of listing each metric name separately')
+    cloudwatch_parser.add_argument(
+        '--resource_cache_file', dest='resource_cache_file', default=None,
+        help='File to keep EC2/EBS ids used by the cloudwatch_filter in '
+             'across runs')
+    cloudwatch_parser.add_argument(
+        '--resource_cache_ttl', dest='resource_cache_ttl', type=int,
+        default=3600,
+        help='Seconds ids in --resource_cache_file stay valid')
 
 
 def new_snapper(awscontext, args):
     return CloudWatchSnap(
-        awscontext, args.namespace, args.metrics, args.dim_filter_rex)
+        awscontext, args.namespace, args.metrics, args.dim_filter_rex,
+        single_pass=args.single_pass,
+        resource_cache=ResourceIdCache(
+            args.resource_cache_file, args.resource_cache_ttl))
@@ -1,5 +1,5 @@
-import boto3
 import logging
+import Queue
 import time
 import traceback
 
@@ -17,7 +17,7 @@ class KinesisSnapper(object):
     def __init__(self, awscontext, streams):
         self.ctx = awscontext
         self.streams = streams
-        self._client = self._create_kinesis_client()
+        self._client = self.ctx.client('kinesis')
 
     def snap(self):
         logging.warn(
@@ -34,6 +34,7 @@ class KinesisSnapper(object):
             logging.warn(
                 'End of collecting meta data for region=%s discoverd=%d took=%s seconds',
                 self.ctx.region, num_streams, time.time() - start)
+            return num_streams
 
     def _do_snap(self):
         # Discover
@@ -51,15 +52,6 @@ class KinesisSnapper(object):
 
         return len(streams)
 
-    def _create_kinesis_client(self):
-        client = boto3.client(
-            'kinesis',
-            region_name=self.ctx.region,
-            aws_access_key_id=self.ctx.access_key,
-            aws_secret_access_key=self.ctx.secret_key,
-        )
-        return client
-
     def _list_streams(self):
         '''
         :return: a list of stream names in this region
@@ -76,7 +68,7 @@ class KinesisSnapper(object):
                 raise Exception(msg)
 
             stream_names.extend(response.get('StreamNames', []))
-            if response.get('HasHasMoreStreams'):
+            if response.get('HasMoreStreams'):
                 params['ExclusiveStartStreamName'] = stream_names[-1]
             else:
                 break
@@ -87,11 +79,13 @@ class KinesisSnapper(object):
         '''
         :param stream_names: a list of stream names
         streams
-        :return: a list of dict, each dict contains
+        :return: a list of dict, the StreamDescriptionSummary of each stream
+        plus all of its shards
         {
         'StreamName': 'string',
         'StreamARN': 'string',
         'StreamStatus': 'CREATING'|'DELETING'|'ACTIVE'|'UPDATING',
+        ...
         'Shards': [
              {
                  'ShardId': 'string',
@@ -109,22 +103,80 @@ class KinesisSnapper(object):
         }
         '''
 
-        streams = []
+        # Describe concurrently on the shared pool, keeping the input order
+        results_q = Queue.Queue()
+        self.ctx.stats.watch_queue(
+            'kinesis:{}:results_q'.format(self.ctx.region), results_q)
         for stream_name in stream_names:
-            response = self._client.describe_stream(
-                StreamName=stream_name)
-
+            self.ctx.pool.submit(
+                self._collect_stream, stream_name, results_q)
+
+        described = {}
+        failed = []
+        for i in xrange(len(stream_names)):
+            stream_name, stream, ok = results_q.get()
+            if not ok:
+                failed.append(stream_name)
+            elif stream is not None:
+                described[stream_name] = stream
+
+        # A snapshot missing streams must not pass as a complete one
+        if failed:
+            raise Exception(
+                'Failed to describe count={} of {} Kinesis streams={} '
+                'region={}'.format(
+                    len(failed), len(stream_names), ','.join(failed[:10]),
+                    self.ctx.region))
+
+        return [described[stream_name] for stream_name in stream_names
+                if stream_name in described]
+
+    def _collect_stream(self, stream_name, results_q):
+        stream, ok = None, False
+        try:
+            stream = self._describe_stream(stream_name)
+            ok = True
+        except Exception:
+            logging.error(
+                'Failed to describe Kinesis stream=%s region=%s error=%s',
+                stream_name, self.ctx.region, traceback.format_exc())
+        finally:
+            results_q.put((stream_name, stream, ok))
+
+    def _describe_stream(self, stream_name):
+        response = self._client.describe_stream_summary(
+            StreamName=stream_name)
+        if not utils.is_http_ok(response):
+            msg = 'Failed to describe Kinesis stream={} region={} errorcode={}'.format(
+                stream_name, self.ctx.region, utils.http_code(response))
+            logging.error(msg)
+            raise Exception(msg)
+
+        stream = response.get('StreamDescriptionSummary')
+        if not stream:
+            return None
+
+        stream['Shards'] = self._list_shards(stream_name)
+        return stream
+
+    def _list_shards(self, stream_name):
+        shards = []
+        params = {'StreamName': stream_name, 'MaxResults': 1000}
+        while 1:
+            response = self._client.list_shards(**params)
             if not utils.is_http_ok(response):
-                msg = 'Failed to describe Kinesis stream={} region={} errorcode={}'.format(
+                msg = 'Failed to list shards of Kinesis stream={} region={} errorcode={}'.format(
                     stream_name, self.ctx.region, utils.http_code(response))
                 logging.error(msg)
                 raise Exception(msg)
 
-            if not response.get('StreamDescription'):
-                continue
-
-            streams.append(response['StreamDescription'])
-        return streams
+            shards.extend(response.get('Shards', []))
+            token = response.get('NextToken')
+            if not token:
+                break
+            # NextToken can not be combined with StreamName
+            params = {'NextToken': token, 'MaxResults': 1000}
+        return shards
 
 
 def add_params(subparsers):
@@ -0,0 +1,162 @@
+import bisect
+
+import s3_records
+
+
+# Upper bounds of the object size histogram buckets in bytes
+SIZE_BUCKETS = tuple(4 ** i * 1024 for i in xrange(12))
+
+
+class PrefixAggregate(object):
+    '''
+    Object count, bytes, size histogram, oldest/newest LastModified and
+    storage class breakdown of the keys of one prefix
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.size = 0
+        self.oldest = None
+        self.newest = None
+        self.size_hist = [0] * (len(SIZE_BUCKETS) + 1)
+        # Storage class to [count, size]
+        self.storage_classes = {}
+
+    def add(self, meta):
+        self.count += 1
+        self.size += meta.size
+        if self.oldest is None or meta.last_modified < self.oldest:
+            self.oldest = meta.last_modified
+        if self.newest is None or meta.last_modified > self.newest:
+            self.newest = meta.last_modified
+        self.size_hist[bisect.bisect_left(SIZE_BUCKETS, meta.size)] += 1
+
+        # Listings leave out the class of STANDARD keys at times
+        name = meta.storage_class or 'STANDARD'
+        storage_class = self.storage_classes.get(name)
+        if storage_class is None:
+            storage_class = self.storage_classes[name] = [0, 0]
+        storage_class[0] += 1
+        storage_class[1] += meta.size
+
+    def merge(self, other):
+        self.count += other.count
+        self.size += other.size
+        if other.oldest is not None and (
+                self.oldest is None or other.oldest < self.oldest):
+            self.oldest = other.oldest
+        if other.newest is not None and (
+                self.newest is None or other.newest > self.newest):
+            self.newest = other.newest
+        for i, count in enumerate(other.size_hist):
+            self.size_hist[i] += count
+
+        for name, (count, size) in other.storage_classes.iteritems():
+            storage_class = self.storage_classes.get(name)
+            if storage_class is None:
+                storage_class = self.storage_classes[name] = [0, 0]
+            storage_class[0] += count
+            storage_class[1] += size
+
+    def to_dict(self, prefix, depth):
+        return {
+            'Prefix': prefix,
+            'Depth': depth,
+            'Count': self.count,
+            'Size': self.size,
+            'OldestLastModified': (
+                s3_records.format_time(self.oldest)
+                if self.oldest is not None else None),
+            'NewestLastModified': (
+                s3_records.format_time(self.newest)
+                if self.newest is not None else None),
+            # Counts per SIZE_BUCKETS bucket, the last one above
+            'SizeHistogram': list(self.size_hist),
+            'SizeBuckets': SIZE_BUCKETS,
+            'StorageClasses': dict(
+                (name, {'Count': count, 'Size': size})
+                for name, (count, size) in self.storage_classes.iteritems()),
+        }
+
+
+class S3Aggregates(object):
+    '''
+    Per prefix aggregates of keys below ``prefix``, one level per '/' down
+    to ``depth`` levels below it. Each collector thread keeps its own and
+    they are merged once collection is done, so adding keys takes no
+    locks. A key is only added to its deepest level, the levels above are
+    rolled up in records().
+    '''
+
+    def __init__(self, prefix, depth):
+        self.prefix = prefix
+        self.depth = depth
+        # Deepest level prefix to PrefixAggregate of the keys right in it
+        self.levels = {}
+
+    def level(self, key):
+        '''
+        :return: the prefix of ``key`` at most ``depth`` levels below
+        ``prefix``
+        '''
+
+        pos = len(self.prefix) - 1
+        for i in xrange(self.depth):
+            next_pos = key.find('/', pos + 1)
+            if next_pos < 0:
+                break
+            pos = next_pos
+        return key[:pos + 1]
+
+    def add(self, key_metas):
+        levels = self.levels
+        base_depth = self.prefix.count('/')
+        level = None
+        # Whether keys below level belong to it as it is the deepest
+        deepest = False
+        aggregate = None
+        for meta in key_metas:
+            # Listed keys are sorted, so neighbours mostly share a level
+            key = meta.key
+            if level is None or not key.startswith(level) or (
+                    not deepest and key.find('/', len(level)) >= 0):
+                level = self.level(key)
+                deepest = level.count('/') - base_depth >= self.depth
+                aggregate = levels.get(level)
+                if aggregate is None:
+                    aggregate = levels[level] = PrefixAggregate()
+            aggregate.add(meta)
+
+    def merge(self, other):
+        for level, aggregate in other.levels.iteritems():
+            mine = self.levels.get(level)
+            if mine is None:
+                mine = self.levels[level] = PrefixAggregate()
+            mine.merge(aggregate)
+
+    def num_keys(self):
+        return sum(aggregate.count for aggregate in self.levels.itervalues())
+
+    def records(self):
+        '''
+        :return: aggregate records of every level, each rolling up the
+        levels below it, sorted by prefix
+        '''
+
+        rolled = {self.prefix: PrefixAggregate()}
+        for level, aggregate in self.levels.iteritems():
+            pos = len(self.prefix) - 1
+            while 1:
+                ancestor = level[:pos + 1]
+                rolled_up = rolled.get(ancestor)
+                if rolled_up is None:
+                    rolled_up = rolled[ancestor] = PrefixAggregate()
+                rolled_up.merge(aggregate)
+                pos = level.find('/', pos + 1)
+                if pos < 0:
+                    break
+
+        base_depth = self.prefix.count('/')
+        return [
+            rolled[prefix].to_dict(prefix, prefix.count('/') - base_depth)
+            for prefix in sorted(rolled)]
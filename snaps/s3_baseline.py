@@ -0,0 +1,238 @@
+import heapq
+import json
+import logging
+import os
+import tempfile
+import time
+
+import event_writer
+import s3_records
+
+
+# Records sorted in memory at a time while building the baseline index
+SORT_CHUNK_RECORDS = 500000
+
+ADDED = 'added'
+MODIFIED = 'modified'
+DELETED = 'deleted'
+
+
+def prefix_end(prefix):
+    '''
+    :return: the lowest key sorting after all keys under ``prefix``
+    '''
+    return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+
+def _index_line(key, last_modified, size):
+    return json.dumps([key, last_modified, size]) + '\n'
+
+
+def _iter_index_lines(fname):
+    with open(fname, 'rb') as f:
+        for line in f:
+            yield json.loads(line)[0], line
+
+
+class S3Baseline(object):
+    '''
+    A previous S3 snapshot kept as an on-disk index of
+    [key, LastModified, Size] lines sorted by key, so snapshots of any size
+    can be diffed against a new listing with bounded memory.
+    '''
+
+    def __init__(self, index_fname):
+        self.index_fname = index_fname
+
+    @classmethod
+    def build(cls, snapshot_fname, index_fname=None):
+        '''
+        External merge sort of a snapshot written by JsonEventWriter into
+        an index. An existing index newer than the snapshot is reused.
+        '''
+
+        index_fname = index_fname or snapshot_fname + '.idx'
+        if (os.path.exists(index_fname) and
+                os.path.getmtime(index_fname) >=
+                os.path.getmtime(snapshot_fname)):
+            return cls(index_fname)
+
+        start = time.time()
+        chunk_fnames = []
+        try:
+            chunk = []
+            for meta in event_writer.iter_events(snapshot_fname):
+                chunk.append(
+                    (meta['Key'], meta['LastModified'], meta['Size']))
+                if len(chunk) >= SORT_CHUNK_RECORDS:
+                    chunk_fnames.append(cls._write_chunk(chunk, index_fname))
+                    chunk = []
+            if chunk or not chunk_fnames:
+                chunk_fnames.append(cls._write_chunk(chunk, index_fname))
+
+            tmp_fname = index_fname + '.tmp'
+            with open(tmp_fname, 'wb') as f:
+                last_key = None
+                for key, line in heapq.merge(
+                        *[_iter_index_lines(fname) for fname in chunk_fnames]):
+                    # Resumed snapshots may hold a key twice
+                    if key != last_key:
+                        f.write(line)
+                        last_key = key
+            os.rename(tmp_fname, index_fname)
+        finally:
+            for fname in chunk_fnames:
+                os.remove(fname)
+
+        logging.warn(
+            'Built baseline index=%s from snapshot=%s took=%s seconds',
+            index_fname, snapshot_fname, time.time() - start)
+        return cls(index_fname)
+
+    @staticmethod
+    def _write_chunk(chunk, index_fname):
+        chunk.sort()
+        fd, fname = tempfile.mkstemp(
+            prefix=os.path.basename(index_fname) + '.',
+            dir=os.path.dirname(os.path.abspath(index_fname)))
+        with os.fdopen(fd, 'wb') as f:
+            for record in chunk:
+                f.write(_index_line(*record))
+        return fname
+
+    def cursor(self, key_range):
+        return BaselineCursor(self.index_fname, key_range)
+
+
+class BaselineCursor(object):
+    '''
+    Walks the baseline records of one KeyRange in step with its listing
+    and turns listing pages into added/modified/deleted records.
+    '''
+
+    def __init__(self, index_fname, key_range):
+        self.key_range = key_range
+        self._file = open(index_fname, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+
+        start = max(key_range.lower, key_range.prefix)
+        self._seek(start)
+        self._record = None
+        self._advance()
+        # Keys up to last_key were diffed before a resume
+        while (self._record is not None and key_range.last_key and
+               self._record[0] <= key_range.last_key):
+            self._advance()
+
+    def close(self):
+        self._file.close()
+
+    def diff(self, key_metas):
+        '''
+        :param key_metas: a sorted page of the listing as KeyMeta
+        :return: change records up to the last key of the page
+        '''
+
+        changes = []
+        for meta in key_metas:
+            key = meta.key
+            while self._record is not None and self._record[0] < key:
+                changes.append(self._deleted())
+                self._advance()
+
+            if self._record is not None and self._record[0] == key:
+                _, last_modified, size = self._record
+                self._advance()
+                if (size == meta.size and
+                        last_modified == meta.last_modified_str()):
+                    continue
+                meta.change_type = MODIFIED
+            else:
+                meta.change_type = ADDED
+            changes.append(meta)
+        return changes
+
+    def diff_level(self, key_metas, common_prefixes):
+        '''
+        Diff a page of a delimiter listing. Records under
+        ``common_prefixes`` are passed over, ranges of their own diff them.
+        :return: change records up to the last key or prefix of the page
+        '''
+
+        items = sorted(
+            [(meta.key, meta) for meta in key_metas] +
+            [(prefix, None) for prefix in common_prefixes])
+        changes = []
+        for key, meta in items:
+            if meta is not None:
+                changes.extend(self.diff([meta]))
+            else:
+                changes.extend(self._skip_prefix(key))
+        return changes
+
+    def drain(self):
+        '''
+        :return: deleted records for the rest of the range
+        '''
+
+        changes = []
+        while self._record is not None and self._in_range(self._record[0]):
+            changes.append(self._deleted())
+            self._advance()
+        return changes
+
+    def _skip_prefix(self, prefix):
+        changes = []
+        while self._record is not None and self._record[0] < prefix:
+            changes.append(self._deleted())
+            self._advance()
+
+        if self._record is not None and self._record[0].startswith(prefix):
+            self._seek(prefix_end(prefix))
+            self._advance()
+        return changes
+
+    def _in_range(self, key):
+        if self.key_range.upper is not None:
+            return key < self.key_range.upper
+        return key.startswith(self.key_range.prefix)
+
+    def _deleted(self):
+        key, last_modified, size = self._record
+        return s3_records.KeyMeta(
+            key, size, s3_records.parse_time(last_modified),
+            change_type=DELETED)
+
+    def _advance(self):
+        line = self._file.readline()
+        self._record = json.loads(line) if line else None
+
+    def _seek(self, key):
+        '''
+        Binary search for the first line with a key >= ``key``
+        '''
+
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            line = self._line_from(mid)
+            if not line or json.loads(line)[0] >= key:
+                hi = mid
+            else:
+                lo = mid + 1
+        self._line_from(lo, skip_only=True)
+
+    def _line_from(self, offset, skip_only=False):
+        '''
+        Position the file at the first line starting at or after ``offset``
+        :return: that line unless ``skip_only``
+        '''
+
+        if offset:
+            self._file.seek(offset - 1)
+            self._file.readline()
+        else:
+            self._file.seek(0)
+
+        if not skip_only:
+            return self._file.readline()
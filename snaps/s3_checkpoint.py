@@ -0,0 +1,87 @@
+import json
+import logging
+import os
+import time
+
+
+class S3Checkpoint(object):
+    '''
+    Tracks per key range progress of an S3 snap, as far as it has been
+    written out, and periodically persists it so a failed snap can resume.
+    Ranges are identified by (prefix, lower) since ranges of one prefix
+    never overlap. ``offset`` is the size of the target file holding the
+    keys written as of the last save, None for SQLite targets.
+    '''
+
+    def __init__(self, fname, interval):
+        self.fname = fname
+        self.interval = interval
+        self.ranges = {}
+        self.offset = None
+        self._last_save = time.time()
+
+    @classmethod
+    def load(cls, fname, interval):
+        checkpoint = cls(fname, interval)
+        with open(fname) as f:
+            data = json.load(f)
+        for state in data['ranges']:
+            checkpoint.ranges[(state['prefix'], state['lower'])] = state
+        checkpoint.offset = data.get('offset')
+        return checkpoint
+
+    def add(self, key_range):
+        self.ranges[(key_range.prefix, key_range.lower)] = {
+            'prefix': key_range.prefix,
+            'lower': key_range.lower,
+            'upper': key_range.upper,
+            'last_key': key_range.last_key,
+            'discover': key_range.discover,
+            'done': False,
+        }
+
+    def update(self, batch):
+        '''
+        Apply the progress carried by a result batch once it is written
+        '''
+
+        key_range = batch.key_range
+        state = self.ranges[(key_range.prefix, key_range.lower)]
+        if batch.last_key:
+            state['last_key'] = batch.last_key
+        state['upper'] = batch.upper
+        state['done'] = batch.done
+        for new_range in batch.new_ranges:
+            self.add(new_range)
+
+    def pending(self):
+        '''
+        :return: a list of (prefix, lower, upper, last_key, discover) of
+        unfinished ranges
+        '''
+        return [(s['prefix'], s['lower'], s['upper'], s['last_key'],
+                 s.get('discover', False))
+                for s in self.ranges.itervalues() if not s['done']]
+
+    def due(self):
+        return time.time() - self._last_save >= self.interval
+
+    def save(self, offset=None):
+        '''
+        Atomically replace the checkpoint file
+        :param offset: size of the target file as returned by the
+        checkpoint() of its writer
+        '''
+
+        self.offset = offset
+        tmp_fname = self.fname + '.tmp'
+        with open(tmp_fname, 'w') as f:
+            json.dump({'ranges': self.ranges.values(), 'offset': offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_fname, self.fname)
+        self._last_save = time.time()
+
+        logging.info(
+            'Saved checkpoint=%s ranges=%d pending=%d',
+            self.fname, len(self.ranges), len(self.pending()))
@@ -0,0 +1,123 @@
+import logging
+import threading
+import time
+import traceback
+
+import event_writer
+
+
+class WorkerProgress(object):
+    '''
+    Counters of one worker thread. Only their worker writes them, the
+    reporter just reads, so they need no locking.
+    '''
+
+    def __init__(self):
+        self.keys = 0
+        self.size = 0
+        self.ranges_started = 0
+        self.ranges_done = 0
+
+
+class S3Progress(object):
+    '''
+    Logs keys/sec, listed object bytes, active/done key ranges and records
+    queued for the writer of an S3 snap every ``interval`` seconds from its
+    own thread.
+    With ``previous_snapshot``, a snapshot or baseline index of the same
+    bucket, it also estimates the completion time from its key count.
+    '''
+
+    def __init__(self, common_log, interval, results_q, writer,
+                 previous_snapshot=None):
+        self.common_log = common_log
+        self.interval = interval
+        self.results_q = results_q
+        self.writer = writer
+        self.previous_snapshot = previous_snapshot
+        self.expected_keys = None
+        self.start_time = time.time()
+        self._workers = []
+        self._workers_lock = threading.Lock()
+        self._local = threading.local()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def worker(self):
+        '''
+        :return: the WorkerProgress of the calling thread
+        '''
+
+        progress = getattr(self._local, 'progress', None)
+        if progress is None:
+            progress = self._local.progress = self.add_worker()
+        return progress
+
+    def add_worker(self):
+        '''
+        :return: a new WorkerProgress, for counters kept by a worker thread
+        or mirrored from a worker process
+        '''
+
+        progress = WorkerProgress()
+        with self._workers_lock:
+            self._workers.append(progress)
+        return progress
+
+    def workers(self):
+        with self._workers_lock:
+            return list(self._workers)
+
+    def start(self):
+        if not self.interval:
+            return
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def report(self):
+        workers = self.workers()
+        keys = sum(w.keys for w in workers)
+        size = sum(w.size for w in workers)
+        started = sum(w.ranges_started for w in workers)
+        done = sum(w.ranges_done for w in workers)
+        took = time.time() - self.start_time
+        keys_per_sec = keys / took if took else 0
+
+        eta = ''
+        if self.expected_keys and keys_per_sec:
+            remaining = max(self.expected_keys - keys, 0)
+            eta = ' expected_keys={} done_pct={:.1f} eta={} seconds ' \
+                  'eta_time={}'.format(
+                      self.expected_keys,
+                      min(100.0, 100.0 * keys / self.expected_keys),
+                      int(remaining / keys_per_sec),
+                      time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(
+                          time.time() + remaining / keys_per_sec)))
+
+        logging.warn(
+            'Progress of %s keys=%d keys_per_sec=%.0f size=%d '
+            'active_ranges=%d done_ranges=%d backlog_records=%d '
+            'written_bytes=%s%s',
+            self.common_log, keys, keys_per_sec, size, started - done, done,
+            self.results_q.qsize() if self.results_q is not None else 0,
+            getattr(self.writer, 'bytes_written', None), eta)
+
+    def _run(self):
+        if self.previous_snapshot:
+            try:
+                self.expected_keys = event_writer.count_events(
+                    self.previous_snapshot)
+            except Exception:
+                logging.warn(
+                    'Failed to count keys of previous snapshot=%s error=%s',
+                    self.previous_snapshot, traceback.format_exc())
+
+        while not self._stopped.wait(self.interval):
+            self.report()
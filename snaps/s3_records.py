@@ -0,0 +1,141 @@
+import calendar
+import json
+import time
+
+import botocore.utils
+
+
+# Epoch of midnight UTC per 'YYYY-MM-DD' and back, keys of a bucket share
+# few days
+_day_epochs = {}
+_epoch_days = {}
+
+
+def _day_epoch(day):
+    epoch = _day_epochs.get(day)
+    if epoch is None:
+        epoch = calendar.timegm(
+            (int(day[0:4]), int(day[5:7]), int(day[8:10]), 0, 0, 0))
+        _day_epochs[day] = epoch
+    return epoch
+
+
+def _epoch_day(days):
+    day = _epoch_days.get(days)
+    if day is None:
+        day = time.strftime('%Y-%m-%d', time.gmtime(days * 86400))
+        _epoch_days[days] = day
+    return day
+
+
+def parse_time(value):
+    '''
+    :param value: a UTC timestamp as listed by S3 like
+    2016-09-01T12:00:00.000Z, or as written to snapshots like
+    2016-09-01 12:00:00+00:00
+    :return: seconds since the epoch
+    '''
+
+    if (len(value) >= 20 and value[10] in 'T ' and
+            (value.endswith('Z') or value.endswith('+00:00'))):
+        epoch = (_day_epoch(value[:10]) + int(value[11:13]) * 3600 +
+                 int(value[14:16]) * 60 + int(value[17:19]))
+        if value[19] == '.':
+            fraction = value[20:].rstrip('Z').split('+')[0]
+            if fraction:
+                epoch += float('0.' + fraction)
+        return epoch
+
+    return datetime_epoch(botocore.utils.parse_timestamp(value))
+
+
+def datetime_epoch(value):
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+def format_time(epoch):
+    '''
+    :return: ``epoch`` as str() of a UTC datetime, the LastModified format of
+    snapshots, like 2016-09-01 12:00:00+00:00
+    '''
+
+    seconds = int(epoch)
+    days, rem = divmod(seconds, 86400)
+    millis = int(round((epoch - seconds) * 1000))
+    if millis:
+        return '%s %02d:%02d:%02d.%03d000+00:00' % (
+            _epoch_day(days), rem // 3600, rem // 60 % 60, rem % 60, millis)
+    return '%s %02d:%02d:%02d+00:00' % (
+        _epoch_day(days), rem // 3600, rem // 60 % 60, rem % 60)
+
+
+class KeyMeta(object):
+    '''
+    Compact record of one S3 key, written as
+    {"Key", "LastModified", "Size", "StorageClass"} plus "ChangeType" in
+    incremental snapshots and any fields added through update().
+    '''
+
+    __slots__ = ('key', 'size', 'last_modified', 'storage_class',
+                 'change_type', 'extra')
+
+    # Table of event_writer.SqliteEventWriter
+    SQLITE_TABLE = 's3_keys'
+
+    def __init__(self, key, size, last_modified, storage_class=None,
+                 change_type=None):
+        self.key = key
+        self.size = size
+        # Seconds since the epoch
+        self.last_modified = last_modified
+        self.storage_class = storage_class
+        self.change_type = change_type
+        self.extra = None
+
+    @classmethod
+    def from_listing(cls, content):
+        '''
+        :param content: an entry of ListObjectsV2 Contents
+        '''
+
+        last_modified = content['LastModified']
+        if isinstance(last_modified, basestring):
+            last_modified = parse_time(last_modified)
+        else:
+            last_modified = datetime_epoch(last_modified)
+        return cls(content['Key'], content['Size'], last_modified,
+                   content.get('StorageClass'))
+
+    def last_modified_str(self):
+        return format_time(self.last_modified)
+
+    def update(self, fields):
+        if self.extra is None:
+            self.extra = {}
+        self.extra.update(fields)
+
+    def to_json(self):
+        out = '{"Key": %s, "LastModified": "%s", "Size": %d' % (
+            json.dumps(self.key), format_time(self.last_modified), self.size)
+        if self.storage_class is not None:
+            out += ', "StorageClass": "%s"' % self.storage_class
+        if self.change_type is not None:
+            out += ', "ChangeType": "%s"' % self.change_type
+        if self.extra:
+            out += ', ' + json.dumps(self.extra)[1:-1]
+        return out + '}'
+
+    def to_row(self):
+        '''
+        :return: the columns of an s3_keys row
+        '''
+        return (self.key, format_time(self.last_modified), self.size,
+                self.storage_class, self.change_type,
+                json.dumps(self.extra) if self.extra else None)
+
+
+def from_listing(contents):
+    '''
+    :return: KeyMeta of the ListObjectsV2 Contents ``contents``
+    '''
+    return [KeyMeta.from_listing(content) for content in contents]
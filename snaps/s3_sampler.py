@@ -0,0 +1,135 @@
+import logging
+import threading
+import traceback
+import zlib
+
+import s3_baseline
+import thread_pool
+import utils
+
+
+# Leading bytes fetched per object, enough for the gzip magic number
+SAMPLE_BYTES = 4
+
+DEFAULT_SAMPLE_CONCURRENCY = 32
+
+# Objects which have to be restored before they can be read
+ARCHIVED_STORAGE_CLASSES = ('GLACIER', 'DEEP_ARCHIVE')
+
+
+class SampleBatch(object):
+    '''
+    Samples of one batch of keys in flight. wait() returns once all of
+    them have been attached to their KeyMeta.
+    '''
+
+    def __init__(self, pending):
+        self._pending = pending
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        if not pending:
+            self._done.set()
+
+    def sampled(self):
+        with self._lock:
+            self._pending -= 1
+            if not self._pending:
+                self._done.set()
+
+    def wait(self):
+        self._done.wait()
+
+
+class HeaderSampler(object):
+    '''
+    Classifies S3 objects as gzip or plain from their first SAMPLE_BYTES
+    bytes, fetched with ranged GETs on a pool of ``concurrency`` threads
+    sharing one client and its connections. ``sample_rate`` of the keys are
+    sampled, picked by a hash of the key so that repeated snaps sample the
+    same keys. Each sampled KeyMeta gets an "Encoding" of "gzip", "plain" or
+    "empty", or a "SampleError" if the GET failed.
+    '''
+
+    def __init__(self, client, bucket_name, sample_rate=1.0,
+                 concurrency=DEFAULT_SAMPLE_CONCURRENCY):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.sample_rate = sample_rate
+        self.pool = thread_pool.ThreadPool(concurrency)
+        self.sampled = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def selected(self, meta):
+        if meta.change_type == s3_baseline.DELETED:
+            return False
+        if meta.storage_class in ARCHIVED_STORAGE_CLASSES:
+            return False
+        if self.sample_rate >= 1:
+            return True
+
+        key = meta.key
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return (zlib.crc32(key) & 0xffffffff) < \
+            self.sample_rate * 0x100000000
+
+    def submit(self, key_metas):
+        '''
+        Queue samples of the selected ``key_metas``
+        :return: SampleBatch to wait for before writing them
+        '''
+
+        selected = []
+        for meta in key_metas:
+            try:
+                if self.selected(meta):
+                    selected.append(meta)
+            except Exception as e:
+                # A key which can not be sampled still gets written
+                self._failed(meta, e)
+
+        batch = SampleBatch(len(selected))
+        for meta in selected:
+            if meta.size:
+                self.pool.submit(self._sample, meta, batch)
+            else:
+                meta.update({'Encoding': 'empty'})
+                batch.sampled()
+        return batch
+
+    def close(self):
+        self.pool.shutdown()
+        logging.warn(
+            'Sampled bucket_name=%s objects=%d errors=%d',
+            self.bucket_name, self.sampled, self.errors)
+
+    def _sample(self, meta, batch):
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket_name, Key=meta.key,
+                Range='bytes=0-{}'.format(SAMPLE_BYTES - 1))
+            body = response['Body']
+            try:
+                data = body.read()
+            finally:
+                body.close()
+
+            meta.update({
+                'Encoding': 'gzip' if utils.is_likely_gzip(data) else 'plain'})
+            with self._lock:
+                self.sampled += 1
+        except Exception as e:
+            self._failed(meta, e)
+        finally:
+            batch.sampled()
+
+    def _failed(self, meta, e):
+        error = getattr(e, 'response', {}).get('Error', {}).get(
+            'Code', e.__class__.__name__)
+        meta.update({'SampleError': error})
+        with self._lock:
+            self.errors += 1
+        logging.warn(
+            'Failed to sample bucket_name=%s key=%s error=%s',
+            self.bucket_name, meta.key, traceback.format_exc())
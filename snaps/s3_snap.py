@@ -1,24 +1,393 @@
-import boto3
+import collections
+import json
+import multiprocessing
+import os
 import Queue
+import shutil
 import threading
 import time
 import traceback
 import logging
 
+import event_writer
+import record_queue
+import s3_aggregates
+import s3_baseline
+import s3_checkpoint
+import s3_progress
+import s3_records
+import s3_sampler
 
-def postprocess_keys(key_metas):
-    for key in key_metas:
-        key['LastModified'] = str(key['LastModified'])
-        del key['ETag']
-    return key_metas
+
+# A worker which has drained this many pages of a range checks whether
+# other workers are idle and if so splits off the rest of its range
+SPLIT_CHECK_PAGES = 5
+
+# Records the collectors may queue up for the writer, and records
+# collected into one write batch
+DEFAULT_QUEUE_RECORDS = 100000
+DEFAULT_BATCH_RECORDS = 5000
+
+# Discovery descends into sub-prefixes, each discovered concurrently, until
+# this many ranges are known or this deep below --prefix. Below that
+# sub-prefixes are collected as they are found
+DISCOVERY_RANGES = 100
+DISCOVERY_DEPTH = 5
+
+# A discovery which has collected this many keys directly under its prefix
+# hands the rest of the prefix over to a collection range, which can split
+DISCOVERY_DIRECT_KEYS = 2000
+
+# Seconds between progress messages of worker processes to the parent
+PROCESS_PROGRESS_INTERVAL = 1
+
+# Prefix levels below --prefix aggregated by default
+DEFAULT_AGGREGATE_DEPTH = 2
+
+# Printable ASCII bounds used when bisecting flat key ranges
+_MIN_CHAR = 0x20
+_MAX_CHAR = 0x7f
+
+
+def _key_before(key):
+    '''
+    :return: a StartAfter value for listing from ``key`` inclusive. It sorts
+    right below ``key``, callers still drop keys < ``key`` in between
+    '''
+    if not key or not ord(key[-1]):
+        return key[:-1]
+    return key[:-1] + unichr(ord(key[-1]) - 1) + u'\ufffd'
+
+
+def _key_after(key):
+    '''
+    :return: the lowest key sorting after ``key``
+    '''
+    return key + u'\x00'
+
+
+def _midpoint(prefix, lo, hi):
+    '''
+    Pick a key under ``prefix`` strictly between ``lo`` and ``hi`` (None for
+    unbounded) to bisect a range of keys which has no sub-prefixes.
+    :return: the key or None if no split point was found
+    '''
+    if hi is not None and not hi.startswith(prefix):
+        hi = None
+
+    out = prefix
+    bounded = hi is not None
+    for i in xrange(len(prefix), len(lo) + 64):
+        c_lo = ord(lo[i]) if i < len(lo) else _MIN_CHAR - 1
+        if bounded and i < len(hi):
+            c_hi = ord(hi[i])
+        else:
+            c_hi = _MAX_CHAR + 1
+
+        if c_hi - c_lo >= 2:
+            return out + unichr((c_lo + c_hi) // 2)
+
+        out += unichr(c_lo)
+        if c_hi != c_lo:
+            bounded = False
+    return None
+
+
+def _bisect(prefix, lo, hi, count):
+    '''
+    Cut the keys between ``lo`` and ``hi`` into up to ``count`` + 1 pieces
+    by repeated bisection
+    :return: a sorted list of split points
+    '''
+    points = []
+    segments = collections.deque([(lo, hi)])
+    while segments and len(points) < count:
+        seg_lo, seg_hi = segments.popleft()
+        mid = _midpoint(prefix, seg_lo, seg_hi)
+        if mid is None:
+            continue
+        points.append(mid)
+        segments.append((seg_lo, mid))
+        segments.append((mid, seg_hi))
+    return sorted(points)
+
+
+def _spread(items, count):
+    '''
+    :return: at most ``count`` items evenly picked from ``items``
+    '''
+    if len(items) <= count:
+        return items
+    step = float(len(items)) / count
+    return [items[int(i * step)] for i in xrange(count)]
+
+
+class KeyRange(object):
+    '''
+    A slice of the bucket listing: keys under ``prefix`` which sort at or
+    after ``lower`` and before ``upper`` (None for unbounded). ``last_key`` is
+    the last key collected so far. A ``discover`` range lists one level of
+    ``prefix`` with a delimiter, collecting the keys directly under it and
+    scheduling ranges for its sub-prefixes.
+    '''
+
+    def __init__(self, prefix, lower='', upper=None, last_key=None,
+                 discover=False):
+        self.prefix = prefix
+        self.lower = lower
+        self.upper = upper
+        self.last_key = last_key
+        self.discover = discover
+
+    def start_after(self):
+        if self.last_key:
+            return self.last_key
+        return _key_before(self.lower)
+
+    def clip(self, key_metas):
+        '''
+        Drop keys outside of [lower, upper) from a listing page
+        :return: (key_metas, reached_upper)
+        '''
+        if not key_metas:
+            return [], False
+
+        if self.lower and key_metas[0]['Key'] < self.lower:
+            key_metas = [k for k in key_metas if k['Key'] >= self.lower]
+
+        if (self.upper is not None and key_metas and
+                key_metas[-1]['Key'] >= self.upper):
+            return [k for k in key_metas if k['Key'] < self.upper], True
+        return key_metas, False
+
+    def split(self, boundaries):
+        '''
+        Hand over the part of this range beyond the first of ``boundaries``
+        to new ranges, one per boundary
+        :return: a list of new KeyRange
+        '''
+        floor = self.last_key or self.lower
+        bounds = sorted(set(
+            b for b in boundaries
+            if b > floor and (self.upper is None or b < self.upper)))
+        if not bounds:
+            return []
+
+        uppers = bounds[1:] + [self.upper]
+        pieces = [KeyRange(self.prefix, lower, upper)
+                  for lower, upper in zip(bounds, uppers)]
+        self.upper = bounds[0]
+        return pieces
+
+    def __str__(self):
+        return 'prefix={} lower={} upper={}{}'.format(
+            self.prefix, self.lower, self.upper,
+            ' discover' if self.discover else '')
+
+
+# What a worker hands to the writer: KeyMeta records of ``key_range``
+# coalesced from one or more pages and the progress of the range as of the
+# last of them, applied to the checkpoint once the keys are written. The
+# writer waits for ``samples`` of the records, if any, before writing them
+ResultBatch = collections.namedtuple(
+    'ResultBatch',
+    'key_range key_metas last_key upper done new_ranges samples')
+
+
+class RangeScheduler(object):
+    '''
+    Task pool of KeyRange run on the shared thread pool. Every range runs as
+    a pool task of its own, at most ``max_workers`` at once, started
+    through ``spawn``. Collectors hand their thread back between ranges, so
+    other snaps sharing the pool get their turn. ``finish`` is called once
+    all ranges, including the ones split off, are done.
+    '''
+
+    def __init__(self, max_workers, spawn, finish):
+        self.max_workers = max_workers
+        self._spawn = spawn
+        self._finish = finish
+        self._lock = threading.Lock()
+        self._tasks = collections.deque()
+        self._pending = 0
+        # Pool tasks started, and those of them yet to take a range
+        self._running = 0
+        self._waiting = 0
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            self._started = True
+            finished = not self._pending
+            spawn = self._to_spawn()
+        self._run(spawn, finished)
+
+    def put(self, key_range):
+        with self._lock:
+            self._tasks.append(key_range)
+            self._pending += 1
+            spawn = self._to_spawn()
+        self._run(spawn, False)
+
+    def get(self):
+        '''
+        :return: the next range, None if there is none and the calling task
+        is to end
+        '''
+
+        with self._lock:
+            self._waiting -= 1
+            if self._tasks:
+                return self._tasks.popleft()
+            self._running -= 1
+            return None
+
+    def task_done(self):
+        with self._lock:
+            self._pending -= 1
+            self._running -= 1
+            finished = not self._pending
+            spawn = self._to_spawn()
+        self._run(spawn, finished)
+
+    def idle_workers(self):
+        '''
+        :return: number of workers which could start if ranges were
+        queued. It is a hint, so no locking
+        '''
+        if self._tasks:
+            return 0
+        return max(0, self.max_workers - self._running)
+
+    def _to_spawn(self):
+        spawn = 0
+        while (self._started and self._waiting < len(self._tasks) and
+               self._running < self.max_workers):
+            self._running += 1
+            self._waiting += 1
+            spawn += 1
+        return spawn
+
+    def _run(self, spawn, finished):
+        for i in xrange(spawn):
+            self._spawn()
+        if finished:
+            self._finish()
+
+
+class ProcessRangeScheduler(object):
+    '''
+    RangeScheduler of a worker process. Ranges come from the parent through
+    ``task_q``; ranges split off and finished ranges are reported to it
+    through ``msg_q``, so the parent hands split ranges to whichever
+    process has idle workers. ``idle`` and ``queued`` are shared counters of
+    workers waiting for a range and of ranges queued in ``task_q``.
+    '''
+
+    def __init__(self, task_q, msg_q, idle, queued):
+        self._task_q = task_q
+        self._msg_q = msg_q
+        self._idle = idle
+        self._queued = queued
+
+    def put(self, key_range):
+        self._msg_q.put(('put', _range_state(key_range)))
+
+    def get(self):
+        with self._idle.get_lock():
+            self._idle.value += 1
+        state = self._task_q.get()
+        with self._idle.get_lock():
+            self._idle.value -= 1
+
+        if state is None:
+            return None
+        with self._queued.get_lock():
+            self._queued.value -= 1
+        return KeyRange(*state)
+
+    def task_done(self):
+        self._msg_q.put(('done',))
+
+    def idle_workers(self):
+        '''
+        :return: a hint, like RangeScheduler.idle_workers()
+        '''
+        return max(0, self._idle.value - self._queued.value)
+
+
+def _range_state(key_range):
+    return (key_range.prefix, key_range.lower, key_range.upper,
+            key_range.last_key, key_range.discover)
+
+
+def shard_fname(fname, index):
+    '''
+    Insert the shard number before the extensions, like
+    s3_meta.part-003.json.gz
+    '''
+
+    dirname, basename = os.path.split(fname)
+    name, dot, exts = basename.partition('.')
+    return os.path.join(
+        dirname, '{}.part-{:03d}{}{}'.format(name, index, dot, exts))
 
 
 class S3Snapper(object):
 
-    def __init__(self, awscontext, bucket_name, prefix):
+    def __init__(self, awscontext, bucket_name, prefix,
+                 checkpoint_file=None, checkpoint_interval=30, resume=False,
+                 baseline=None, baseline_index=None, progress_interval=60,
+                 previous_snapshot=None, queue_records=DEFAULT_QUEUE_RECORDS,
+                 batch_records=DEFAULT_BATCH_RECORDS, processes=1,
+                 keep_shards=False, aggregates_file=None,
+                 aggregates_only=False,
+                 aggregate_depth=DEFAULT_AGGREGATE_DEPTH, sample_rate=0,
+                 sample_concurrency=s3_sampler.DEFAULT_SAMPLE_CONCURRENCY):
+        if processes > 1 and checkpoint_file:
+            raise Exception(
+                'Checkpoints are not supported with worker processes')
+        if aggregates_file and aggregates_only:
+            raise Exception(
+                'Aggregate-only snaps write aggregates to the target file')
+        if (aggregates_file or aggregates_only) and checkpoint_file:
+            raise Exception('Checkpoints are not supported with aggregates')
+        if aggregates_only and baseline:
+            raise Exception(
+                'Aggregate-only snaps have no keys to diff with a baseline')
+        if aggregates_only and sample_rate:
+            raise Exception('Aggregate-only snaps have no keys to sample')
+
         self.ctx = awscontext
         self.bucket_name = bucket_name
         self.prefix = prefix
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_interval = checkpoint_interval
+        self.resume = resume
+        self.baseline_snapshot = baseline
+        self.baseline_index = baseline_index
+        self.baseline = None
+        self.progress_interval = progress_interval
+        self.previous_snapshot = previous_snapshot
+        self.progress = None
+        self.queue_records = queue_records
+        self.batch_records = batch_records
+        self.processes = processes
+        self.keep_shards = keep_shards
+        self.aggregates_file = aggregates_file
+        self.aggregates_only = aggregates_only
+        self.aggregate_depth = aggregate_depth
+        # S3Aggregates of every collector thread
+        self._aggregates = []
+        self._aggregates_lock = threading.Lock()
+        self._local = threading.local()
+        self.sample_rate = sample_rate
+        self.sample_concurrency = sample_concurrency
+        self.sampler = None
+        # (prefix, lower) of ranges a resumed checkpoint knows already
+        self._known_ranges = set()
+        self._num_ranges = 0
+        self._num_ranges_lock = threading.Lock()
         self.common_log = 'region={} bucket_name={} prefix={}'.format(
             self.ctx.region, self.bucket_name, self.prefix)
 
@@ -37,139 +406,694 @@ class S3Snapper(object):
             logging.warn(
                 'End of collecting meta data for %s discoverd=%d took=%s seconds',
                 self.common_log, num_keys, time.time() - start)
+            return num_keys
 
     def _do_snap(self):
+        if self.baseline_snapshot:
+            self.baseline = s3_baseline.S3Baseline.build(
+                self.baseline_snapshot, self.baseline_index)
+
         # Discover
-        prefixes = self._discover_prefixes()
-        logging.warn(
-            'Discovered %s with count=%d sub-prefixes:\n %s',
-            self.common_log, len(prefixes), '\n'.join(prefixes))
+        # Discovery runs as ranges of the collection, starting with --prefix
+        checkpoint = self._load_checkpoint()
+        if checkpoint is not None and self.resume:
+            key_ranges = [KeyRange(*state) for state in checkpoint.pending()]
+            self._known_ranges = set(checkpoint.ranges)
+            self._num_ranges = len(checkpoint.ranges)
+            logging.warn(
+                'Resuming %s from checkpoint=%s with count=%d ranges',
+                self.common_log, self.checkpoint_file, len(key_ranges))
+        else:
+            key_ranges = [KeyRange(self.prefix, discover=True)]
+            self._num_ranges = 1
+            if checkpoint is not None:
+                for key_range in key_ranges:
+                    checkpoint.add(key_range)
 
         # Collect
-        workers = []
-        results_q = Queue.Queue(10000)
-        task_q = Queue.Queue()
-        for prefix in prefixes:
-            task_q.put(prefix)
+        previous_snapshot = self.previous_snapshot
+        if previous_snapshot is None and self.baseline is not None:
+            previous_snapshot = self.baseline.index_fname
+        if self.processes > 1:
+            return self._collect_in_processes(key_ranges, previous_snapshot)
+
+        results_q = record_queue.RecordQueue(self.queue_records)
+        self.ctx.stats.watch_queue(
+            's3:{}:{}:results_q'.format(self.bucket_name, self.prefix),
+            results_q)
+        scheduler = RangeScheduler(
+            self.ctx.concurrency,
+            lambda: self.ctx.pool.submit(
+                self._collect_range, scheduler, results_q),
+            lambda: results_q.put(None))
+        for key_range in key_ranges:
+            scheduler.put(key_range)
+
+        self.progress = s3_progress.S3Progress(
+            self.common_log, self.progress_interval, results_q,
+            self.ctx.eventwriter, previous_snapshot)
+        self.progress.start()
+
+        self._start_sampler(self.sample_concurrency)
+        scheduler.start()
+
+        try:
+            num_keys = self._write_results(results_q, checkpoint, 1)
+        finally:
+            self.progress.stop()
+            self._stop_sampler()
+
+        if self.aggregates_file or self.aggregates_only:
+            return self._write_aggregates(self._merged_aggregates())
+        return num_keys
+
+    def _collect_in_processes(self, key_ranges, previous_snapshot):
+        '''
+        Collect with worker processes, each listing ranges on its own
+        threads into its own output shard, so parsing and serialization
+        scale past one core. The shards are concatenated into the target
+        file, which is valid for plain, gzip and zstd output alike, or
+        kept and listed in a manifest.
+        '''
+
+        writer = self.ctx.eventwriter
+        if not isinstance(writer, event_writer.JsonEventWriter):
+            raise Exception(
+                'Worker processes need a JSON target file of their own')
+
+        threads = max(1, self.ctx.concurrency // self.processes)
+        task_q = multiprocessing.Queue()
+        msg_q = multiprocessing.Queue()
+        idle = multiprocessing.Value('i', 0)
+        queued = multiprocessing.Value('i', 0)
+
+        self.progress = s3_progress.S3Progress(
+            self.common_log, self.progress_interval, None, None,
+            previous_snapshot)
+        shards, processes, progresses = [], [], []
+        for i in xrange(self.processes):
+            shards.append(shard_fname(writer.fname, i))
+            progresses.append(self.progress.add_worker())
+            process = multiprocessing.Process(
+                target=self._run_process,
+                args=(i, shards[i], threads, task_q, msg_q, idle, queued))
+            process.daemon = True
+            process.start()
+            processes.append(process)
+        self.progress.start()
+
+        def schedule(state):
+            with queued.get_lock():
+                queued.value += 1
+            task_q.put(state)
+
+        pending = 0
+        for key_range in key_ranges:
+            schedule(_range_state(key_range))
+            pending += 1
+        if not pending:
+            for i in xrange(threads * self.processes):
+                task_q.put(None)
+
+        shard_keys = {}
+        aggregates = s3_aggregates.S3Aggregates(
+            self.prefix, self.aggregate_depth)
+        try:
+            while len(shard_keys) < self.processes:
+                try:
+                    msg = msg_q.get(timeout=PROCESS_PROGRESS_INTERVAL)
+                except Queue.Empty:
+                    for i, process in enumerate(processes):
+                        if i not in shard_keys and not process.is_alive():
+                            raise Exception(
+                                'Worker process={} exited with code={}'.format(
+                                    i, process.exitcode))
+                    continue
+
+                if msg[0] == 'put':
+                    schedule(msg[1])
+                    pending += 1
+                elif msg[0] == 'done':
+                    pending -= 1
+                    if not pending:
+                        for i in xrange(threads * self.processes):
+                            task_q.put(None)
+                elif msg[0] == 'progress':
+                    i, keys, size, started, done = msg[1:]
+                    progresses[i].keys = keys
+                    progresses[i].size = size
+                    progresses[i].ranges_started = started
+                    progresses[i].ranges_done = done
+                elif msg[0] == 'aggregates':
+                    aggregates.merge(msg[2])
+                elif msg[0] == 'stats':
+                    self.ctx.stats.add_process(
+                        'process-{}'.format(msg[1]), msg[2])
+                elif msg[0] == 'exit':
+                    i, num_keys = msg[1:]
+                    if num_keys is None:
+                        raise Exception(
+                            'Worker process={} failed'.format(i))
+                    shard_keys[i] = num_keys
+        finally:
+            self.progress.stop()
+            for process in processes:
+                if process.is_alive() and len(shard_keys) < self.processes:
+                    process.terminate()
+                process.join()
+
+        self._finish_shards(writer, shards, shard_keys)
+        if self.aggregates_file or self.aggregates_only:
+            return self._write_aggregates(aggregates)
+        return sum(shard_keys.itervalues())
+
+    def _finish_shards(self, writer, shards, shard_keys):
+        # The shards are the output of the writer, for its run stats
+        writer.records_written += sum(shard_keys.itervalues())
+        writer.bytes_written += sum(
+            os.path.getsize(fname) for fname in shards)
+
+        if self.keep_shards:
+            manifest_fname = writer.fname + '.manifest'
+            with open(manifest_fname, 'w') as f:
+                json.dump({
+                    'shards': [
+                        {'fname': fname, 'records': shard_keys[i]}
+                        for i, fname in enumerate(shards)],
+                }, f, indent=2)
+            logging.warn(
+                'Wrote manifest=%s of count=%d shards for %s',
+                manifest_fname, len(shards), self.common_log)
+            return
+
+        start = time.time()
+        with open(writer.fname, writer.mode + 'b') as out:
+            for fname in shards:
+                with open(fname, 'rb') as f:
+                    shutil.copyfileobj(f, out, writer.buffer_size)
+                os.remove(fname)
+        logging.warn(
+            'Merged count=%d shards into file=%s took=%s seconds',
+            len(shards), writer.fname, time.time() - start)
+
+    def _run_process(self, index, fname, threads, task_q, msg_q, idle,
+                     queued):
+        num_keys = None
+        try:
+            parent = self.ctx.eventwriter
+            writer = event_writer.JsonEventWriter(
+                fname, 'w', parent.buffer_size, parent.compression)
+            self.ctx = self.ctx.for_process(writer, threads, self.processes)
+            num_keys = self._collect_in_process(
+                index, threads, ProcessRangeScheduler(
+                    task_q, msg_q, idle, queued), msg_q)
+            if self.aggregates_file or self.aggregates_only:
+                msg_q.put(('aggregates', index, self._merged_aggregates()))
+            self.ctx.close()
+            msg_q.put(('stats', index, self.ctx.stats.process_state()))
+        except Exception:
+            logging.error(
+                'Failed to collect in worker process=%s %s error=%s',
+                index, self.common_log, traceback.format_exc())
+        msg_q.put(('exit', index, num_keys))
+
+    def _collect_in_process(self, index, threads, scheduler, msg_q):
+        results_q = record_queue.RecordQueue(
+            max(1, self.queue_records // self.processes))
+        self.ctx.stats.watch_queue(
+            's3:{}:{}:results_q:process-{}'.format(
+                self.bucket_name, self.prefix, index), results_q)
+        self.ctx.stats.watch_writer(
+            self.ctx.eventwriter.fname, self.ctx.eventwriter)
+        self.progress = s3_progress.S3Progress(
+            self.common_log, 0, results_q, self.ctx.eventwriter)
+        stopped = threading.Event()
+
+        def report_progress():
+            while 1:
+                stop = stopped.wait(PROCESS_PROGRESS_INTERVAL)
+                workers = self.progress.workers()
+                msg_q.put(('progress', index,
+                           sum(w.keys for w in workers),
+                           sum(w.size for w in workers),
+                           sum(w.ranges_started for w in workers),
+                           sum(w.ranges_done for w in workers)))
+                msg_q.put(('stats', index, self.ctx.stats.process_state()))
+                if stop:
+                    break
+
+        reporter = threading.Thread(target=report_progress)
+        reporter.daemon = True
+        reporter.start()
+
+        self._start_sampler(
+            max(1, self.sample_concurrency // self.processes))
+        for i in xrange(threads):
+            self.ctx.pool.submit(
+                self._collect_key_metas, scheduler, results_q)
+        try:
+            return self._write_results(results_q, None, threads)
+        finally:
+            stopped.set()
+            reporter.join()
+            self._stop_sampler()
+
+    def _start_sampler(self, concurrency):
+        if not self.sample_rate:
+            return
+
+        self.sampler = s3_sampler.HeaderSampler(
+            self.ctx.client('s3', pool_size=concurrency), self.bucket_name,
+            self.sample_rate, concurrency)
+
+    def _stop_sampler(self):
+        if self.sampler is not None:
+            self.sampler.close()
+            self.sampler = None
 
-        for i in xrange(self.ctx.concurrency):
-            task_q.put(None)
-            worker = threading.Thread(
-                target=self._collect_key_metas, args=(task_q, results_q))
-            worker.start()
-            workers.append(worker)
+    def _write_results(self, results_q, checkpoint, num_workers):
+        '''
+        Write batches of ``results_q`` until ``num_workers`` None's arrive
+        '''
 
-        # Index
         worker_done = 0
         num_keys = 0
         with self.ctx.eventwriter as writer:
             while 1:
-                key_metas = results_q.get()
-                if key_metas is not None:
-                    key_metas = postprocess_keys(key_metas)
-                    num_keys += len(key_metas)
-                    writer.write(key_metas)
+                batch = results_q.get()
+                if batch is not None:
+                    if batch.samples is not None:
+                        batch.samples.wait()
+                    if batch.key_metas:
+                        num_keys += len(batch.key_metas)
+                        writer.write(batch.key_metas)
+
+                    if checkpoint is not None:
+                        checkpoint.update(batch)
+                        if checkpoint.due():
+                            checkpoint.save(writer.checkpoint())
                 else:
                     worker_done += 1
-                    if worker_done == self.ctx.concurrency:
+                    if worker_done == num_workers:
                         break
 
-        for worker in workers:
-            worker.join()
+            if checkpoint is not None:
+                checkpoint.save(writer.checkpoint())
 
         return num_keys
 
-    def _collect_key_metas(self, task_q, result_q):
+    def _write_aggregates(self, aggregates):
+        '''
+        Write the rolled up ``aggregates`` to the target file of an
+        aggregate-only snap, or to the aggregates file
+        :return: number of keys aggregated
+        '''
+
+        if self.aggregates_only:
+            writer = self.ctx.eventwriter
+        else:
+            writer = event_writer.new_writer(self.aggregates_file)
+        with writer:
+            writer.write(aggregates.records())
+        return aggregates.num_keys()
+
+    def _load_checkpoint(self):
+        if not self.checkpoint_file:
+            return None
+
+        if self.resume and os.path.exists(self.checkpoint_file):
+            checkpoint = s3_checkpoint.S3Checkpoint.load(
+                self.checkpoint_file, self.checkpoint_interval)
+            self._truncate_target(checkpoint.offset)
+            return checkpoint
+
+        if self.resume:
+            logging.warn(
+                'No checkpoint=%s to resume %s from, starting over',
+                self.checkpoint_file, self.common_log)
+            self.resume = False
+            if not event_writer.is_sqlite(self.ctx.eventwriter.fname):
+                self._truncate_target(0)
+        return s3_checkpoint.S3Checkpoint(
+            self.checkpoint_file, self.checkpoint_interval)
+
+    def _truncate_target(self, offset):
+        '''
+        Cut off what a failed snap wrote after its last checkpoint save.
+        It is written again, and may end in a torn record or an unfinished
+        gzip member or zstd frame.
+        '''
+
+        fname = self.ctx.eventwriter.fname
+        if offset is None or not os.path.exists(fname):
+            return
+
+        size = os.path.getsize(fname)
+        if size < offset:
+            raise Exception(
+                'Target file={} of size={} is shorter than offset={} of '
+                'checkpoint={}, can not resume'.format(
+                    fname, size, offset, self.checkpoint_file))
+        if size > offset:
+            with open(fname, 'r+b') as f:
+                f.truncate(offset)
+            logging.warn(
+                'Truncated file=%s from size=%d to offset=%d of checkpoint=%s',
+                fname, size, offset, self.checkpoint_file)
+
+    def _collect_range(self, scheduler, result_q):
+        '''
+        Pool task collecting one range of a RangeScheduler
+        '''
+
+        key_range = scheduler.get()
+        if key_range is None:
+            return
+
+        try:
+            self._do_collect(key_range, scheduler, result_q)
+        except Exception:
+            logging.warn('Failed to handle %s %s error=%s',
+                         self.common_log, key_range, traceback.format_exc())
+        finally:
+            scheduler.task_done()
+
+    def _collect_key_metas(self, scheduler, result_q):
+        '''
+        Collect ranges of a ProcessRangeScheduler until all are done
+        '''
+
         while 1:
-            prefix = task_q.get()
-            if prefix is None:
-                task_q.put(None)
+            key_range = scheduler.get()
+            if key_range is None:
                 break
 
             try:
-                self._do_collect(prefix, result_q)
+                self._do_collect(key_range, scheduler, result_q)
             except Exception:
-                logging.warn('Failed to handle %s error=%s',
-                             self.common_log, traceback.format_exc())
+                logging.warn('Failed to handle %s %s error=%s',
+                             self.common_log, key_range,
+                             traceback.format_exc())
+            finally:
+                scheduler.task_done()
 
         result_q.put(None)
 
-    def _do_collect(self, prefix, result_q):
-        client = boto3.client(
-            's3',
-            aws_access_key_id=self.ctx.access_key,
-            aws_secret_access_key=self.ctx.secret_key,
-        )
+    def _do_collect(self, key_range, scheduler, result_q):
+        client = self.ctx.client('s3', raw_timestamps=True)
+        progress = self.progress.worker()
+        progress.ranges_started += 1
 
         params = {
             'Bucket': self.bucket_name,
             'MaxKeys': 1000,
-            'Prefix': prefix,
+            'Prefix': key_range.prefix,
             'FetchOwner': False,
         }
+        start_after = key_range.start_after()
+        if start_after:
+            params['StartAfter'] = start_after
+
+        cursor = None
+        if self.baseline is not None:
+            cursor = self.baseline.cursor(key_range)
+
+        try:
+            if key_range.discover:
+                params['Delimiter'] = '/'
+                self._discover(client, params, key_range, cursor, scheduler,
+                               result_q, progress)
+            else:
+                self._do_list(client, params, key_range, cursor, scheduler,
+                              result_q, progress)
+        finally:
+            progress.ranges_done += 1
+            if cursor is not None:
+                cursor.close()
 
+    def _do_list(self, client, params, key_range, cursor, scheduler,
+                 result_q, progress):
         start_time = time.time()
         num_keys = 0
+        num_pages = 0
+        # Records not handed to the writer yet
+        pending = []
         while 1:
             response = client.list_objects_v2(**params)
             next_token = response.get('NextContinuationToken')
-            if response.get('Contents'):
-                num_keys += len(response['Contents'])
-                result_q.put(response['Contents'])
+            contents, reached_upper = key_range.clip(response.get('Contents'))
+            key_metas = s3_records.from_listing(contents)
+            if key_metas:
+                num_keys += len(key_metas)
+                key_range.last_key = key_metas[-1].key
+                progress.keys += len(key_metas)
+                progress.size += sum(meta.size for meta in key_metas)
+                key_metas = self._aggregate(key_metas)
+
+            done = (reached_upper or not next_token or
+                    not response.get('Contents'))
+            if cursor is not None:
+                # Emit changes only
+                key_metas = cursor.diff(key_metas)
+                if done:
+                    key_metas.extend(cursor.drain())
+            pending.extend(key_metas)
+            if len(pending) >= self.batch_records or done:
+                self._put_batch(result_q, key_range, pending, done)
+                pending = []
 
-            if not next_token or not response.get('Contents'):
+            if done:
                 logging.warn(
-                    'Done with region=%s bucket_name=%s prefix=%s discoverd=%d '
+                    'Done with region=%s bucket_name=%s %s discoverd=%d '
                     'took=%s seconds',
-                    self.ctx.region, self.bucket_name, prefix,
+                    self.ctx.region, self.bucket_name, key_range,
                     num_keys, time.time() - start_time)
                 break
 
-            if next_token:
-                params['ContinuationToken'] = next_token
+            num_pages += 1
+            if num_pages % SPLIT_CHECK_PAGES == 0 and key_range.last_key:
+                # Both change under other workers, so read them once
+                idle = scheduler.idle_workers()
+                queued = self.ctx.pool.queued()
+                # Keys up to last_key reach the writer, and the checkpoint,
+                # ahead of a split or yield
+                if pending and (idle or queued):
+                    self._put_batch(result_q, key_range, pending, False)
+                    pending = []
+                if idle:
+                    self._split(client, key_range, idle, scheduler, result_q)
+                if queued:
+                    # Hand the thread to tasks waiting for the shared pool
+                    # and carry on after last_key behind them
+                    scheduler.put(key_range)
+                    logging.info(
+                        'Yielded %s bucket_name=%s at last_key=%s',
+                        key_range, self.bucket_name, key_range.last_key)
+                    break
+
+            params['ContinuationToken'] = next_token
 
-    def _discover_prefixes(self):
-        client = boto3.client(
-            's3',
-            aws_access_key_id=self.ctx.access_key,
-            aws_secret_access_key=self.ctx.secret_key,
-        )
+    def _discover(self, client, params, key_range, cursor, scheduler,
+                  result_q, progress):
+        '''
+        Page through one level of ``key_range.prefix``. Ranges for the
+        sub-prefixes are scheduled page by page, so collection starts while
+        discovery goes on.
+        '''
 
-        all_discovered = []
-        prefixes = [self.prefix]
-        num_iteration = 0
+        start_time = time.time()
+        num_keys = 0
+        num_prefixes = 0
         while 1:
-            num_iteration += 1
-            for prefix in prefixes:
-                response = client.list_objects_v2(
-                    Bucket=self.bucket_name,
-                    Delimiter='/',
-                    MaxKeys=1000,
-                    Prefix=prefix,
-                    FetchOwner=True,
-                )
-
-                common_prefixes = response.get('CommonPrefixes')
-                if common_prefixes is None:
-                    all_discovered.append(prefix)
-                    continue
+            response = client.list_objects_v2(**params)
+            next_token = response.get('NextContinuationToken')
+            contents = response.get('Contents') or []
+            common_prefixes = [
+                p['Prefix'] for p in response.get('CommonPrefixes') or []]
+            reached_upper = False
+            if key_range.upper is not None:
+                # A resumed discovery stops where it handed over before
+                reached_upper = (
+                    (contents and contents[-1]['Key'] >= key_range.upper) or
+                    (common_prefixes and
+                     common_prefixes[-1] >= key_range.upper))
+                contents = [
+                    c for c in contents if c['Key'] < key_range.upper]
+                common_prefixes = [
+                    p for p in common_prefixes if p < key_range.upper]
+
+            key_metas = s3_records.from_listing(contents)
+            if key_metas:
+                num_keys += len(key_metas)
+                key_range.last_key = key_metas[-1].key
+                progress.keys += len(key_metas)
+                progress.size += sum(meta.size for meta in key_metas)
+                key_metas = self._aggregate(key_metas)
+
+            new_ranges = self._sub_prefix_ranges([
+                common_prefix for common_prefix in common_prefixes
+                if (common_prefix, '') not in self._known_ranges])
+            num_prefixes += len(common_prefixes)
+
+            done = reached_upper or not next_token
+            if (not done and num_keys >= DISCOVERY_DIRECT_KEYS and
+                    (contents or common_prefixes)):
+                # Hand the rest over to a range which can split
+                lower = max(
+                    [_key_after(c['Key']) for c in contents[-1:]] +
+                    [s3_baseline.prefix_end(p) for p in common_prefixes[-1:]])
+                key_range.upper = lower
+                new_ranges.append(KeyRange(key_range.prefix, lower))
+                done = True
 
-                all_discovered.extend([p['Prefix'] for p in common_prefixes])
+            if cursor is not None:
+                key_metas = cursor.diff_level(key_metas, common_prefixes)
+                if done:
+                    key_metas.extend(cursor.drain())
 
-            if len(prefixes) != 1 and len(prefixes) == len(all_discovered):
-                # No new prefixed discovered
+            # The writer learns about new ranges before any of their keys
+            result_q.put(ResultBatch(
+                key_range, key_metas, key_range.last_key, key_range.upper,
+                done, new_ranges, self._sample(key_metas)), len(key_metas))
+            for new_range in new_ranges:
+                scheduler.put(new_range)
+
+            if done:
+                logging.warn(
+                    'Discovered region=%s bucket_name=%s %s '
+                    'sub-prefixes=%d direct_keys=%d took=%s seconds',
+                    self.ctx.region, self.bucket_name, key_range,
+                    num_prefixes, num_keys, time.time() - start_time)
                 break
 
-            if len(all_discovered) > 100 or num_iteration > 5:
+            params['ContinuationToken'] = next_token
+
+    def _sub_prefix_ranges(self, prefixes):
+        '''
+        :return: ranges discovering ``prefixes`` further, or collecting them
+        once discovery went deep or wide enough
+        '''
+
+        with self._num_ranges_lock:
+            self._num_ranges += len(prefixes)
+            num_ranges = self._num_ranges
+
+        key_ranges = []
+        for prefix in prefixes:
+            depth = prefix[len(self.prefix):].count('/')
+            discover = (num_ranges <= DISCOVERY_RANGES and
+                        depth < DISCOVERY_DEPTH)
+            key_ranges.append(KeyRange(prefix, discover=discover))
+        return key_ranges
+
+    def _aggregate(self, key_metas):
+        '''
+        Add ``key_metas`` to the aggregates of the calling thread
+        :return: the records to write, none in aggregate-only snaps
+        '''
+
+        if not (self.aggregates_file or self.aggregates_only):
+            return key_metas
+
+        aggregates = getattr(self._local, 'aggregates', None)
+        if aggregates is None:
+            aggregates = self._local.aggregates = s3_aggregates.S3Aggregates(
+                self.prefix, self.aggregate_depth)
+            with self._aggregates_lock:
+                self._aggregates.append(aggregates)
+        aggregates.add(key_metas)
+        return [] if self.aggregates_only else key_metas
+
+    def _merged_aggregates(self):
+        merged = s3_aggregates.S3Aggregates(self.prefix, self.aggregate_depth)
+        with self._aggregates_lock:
+            for aggregates in self._aggregates:
+                merged.merge(aggregates)
+        return merged
+
+    def _sample(self, key_metas):
+        '''
+        Start sampling the object headers of ``key_metas``
+        :return: SampleBatch to wait for, None when not sampling
+        '''
+
+        if self.sampler is None or not key_metas:
+            return None
+
+        try:
+            return self.sampler.submit(key_metas)
+        except Exception:
+            # Sampling is best effort, the keys get written regardless
+            logging.warn(
+                'Failed to sample %s error=%s',
+                self.common_log, traceback.format_exc())
+            return None
+
+    def _put_batch(self, result_q, key_range, key_metas, done):
+        result_q.put(ResultBatch(
+            key_range, key_metas, key_range.last_key, key_range.upper, done,
+            (), self._sample(key_metas)), len(key_metas))
+
+    def _split(self, client, key_range, wanted, scheduler, result_q):
+        '''
+        Hand over the not yet listed part of ``key_range`` to ``wanted``
+        idle workers. Prefer sub-prefix boundaries, fall back to bisecting
+        the key space.
+        '''
+
+        boundaries = self._sub_prefix_boundaries(client, key_range, wanted)
+        if not boundaries:
+            boundaries = _bisect(
+                key_range.prefix, key_range.last_key, key_range.upper,
+                wanted)
+
+        pieces = key_range.split(boundaries)
+        if not pieces:
+            return
+
+        # Let the writer learn about new ranges before any of their keys
+        result_q.put(ResultBatch(
+            key_range, None, key_range.last_key, key_range.upper, False,
+            pieces, None))
+        for piece in pieces:
+            scheduler.put(piece)
+
+        logging.info(
+            'Split %s bucket_name=%s into count=%d ranges at last_key=%s',
+            key_range, self.bucket_name, len(pieces) + 1, key_range.last_key)
+
+    def _sub_prefix_boundaries(self, client, key_range, wanted):
+        '''
+        Walk down the "directories" of the last collected key and gather
+        sibling sub-prefixes which sort after it
+        :return: at most ``wanted`` sorted boundary keys
+        '''
+
+        last_key = key_range.last_key
+        level = key_range.prefix
+        boundaries = []
+        while len(boundaries) < wanted:
+            response = client.list_objects_v2(
+                Bucket=self.bucket_name,
+                Delimiter='/',
+                MaxKeys=1000,
+                Prefix=level,
+                StartAfter=last_key,
+                FetchOwner=False,
+            )
+
+            for common_prefix in response.get('CommonPrefixes') or []:
+                boundary = common_prefix['Prefix']
+                if boundary > last_key and (
+                        key_range.upper is None or boundary < key_range.upper):
+                    boundaries.append(boundary)
+
+            pos = last_key.find('/', len(level))
+            if pos < 0:
                 break
-            else:
-                prefixes = all_discovered
-                all_discovered = []
+            level = last_key[:pos + 1]
 
-        if all_discovered:
-            return all_discovered
-        else:
-            return prefixes
+        return _spread(sorted(boundaries), wanted)
 
 
 def add_params(subparsers):
@@ -180,7 +1104,88 @@ def add_params(subparsers):
     s3parser.add_argument(
         '--prefix', dest='prefix', default='',
         help='S3 bucket prefix like AWSLogs/')
+    s3parser.add_argument(
+        '--checkpoint_file', dest='checkpoint_file', default=None,
+        help='File to periodically record per prefix progress in')
+    s3parser.add_argument(
+        '--checkpoint_interval', dest='checkpoint_interval', type=int,
+        default=30, help='Seconds between checkpoint saves')
+    s3parser.add_argument(
+        '--resume', dest='resume', action='store_true', default=False,
+        help='Resume from --checkpoint_file, appending to --target_file. '
+             'Keys written after the last checkpoint save are cut off the '
+             'target file and written again')
+    s3parser.add_argument(
+        '--baseline', dest='baseline', default=None,
+        help='Previous snapshot of the same bucket. Only keys added, '
+             'modified or deleted since then are written, tagged with '
+             'ChangeType')
+    s3parser.add_argument(
+        '--baseline_index', dest='baseline_index', default=None,
+        help='Sorted index file built from --baseline, defaults to '
+             '<baseline>.idx')
+    s3parser.add_argument(
+        '--queue_records', dest='queue_records', type=int,
+        default=DEFAULT_QUEUE_RECORDS,
+        help='Max records queued between the collectors and the writer')
+    s3parser.add_argument(
+        '--batch_records', dest='batch_records', type=int,
+        default=DEFAULT_BATCH_RECORDS,
+        help='Records collected into one write batch')
+    s3parser.add_argument(
+        '--processes', dest='processes', type=int, default=1,
+        help='Worker processes sharing --concurrency threads, each writing '
+             'its own shard of --target_file. Not supported with '
+             '--checkpoint_file')
+    s3parser.add_argument(
+        '--keep_shards', dest='keep_shards', action='store_true',
+        default=False,
+        help='Keep the shards of --processes with a <target_file>.manifest '
+             'listing them instead of merging them into --target_file')
+    s3parser.add_argument(
+        '--progress_interval', dest='progress_interval', type=int,
+        default=60, help='Seconds between progress logs, 0 disables them')
+    s3parser.add_argument(
+        '--previous_snapshot', dest='previous_snapshot', default=None,
+        help='Previous snapshot of the same bucket whose key count gives '
+             'the progress an ETA, defaults to the --baseline index')
+    s3parser.add_argument(
+        '--aggregates_file', dest='aggregates_file', default=None,
+        help='File to write per prefix aggregates to next to the keys: '
+             'count, size, size histogram, oldest/newest LastModified and '
+             'storage classes of every prefix level')
+    s3parser.add_argument(
+        '--aggregates_only', dest='aggregates_only', action='store_true',
+        default=False,
+        help='Write per prefix aggregates to --target_file instead of keys')
+    s3parser.add_argument(
+        '--aggregate_depth', dest='aggregate_depth', type=int,
+        default=DEFAULT_AGGREGATE_DEPTH,
+        help='Prefix levels below --prefix to aggregate, deeper keys count '
+             'toward their level at this depth')
+    s3parser.add_argument(
+        '--sample_rate', dest='sample_rate', type=float, default=0,
+        help='Fraction of keys whose first bytes are fetched with a ranged '
+             'GET to record their Encoding, gzip or plain. 1 samples all '
+             'keys, 0 disables sampling')
+    s3parser.add_argument(
+        '--sample_concurrency', dest='sample_concurrency', type=int,
+        default=s3_sampler.DEFAULT_SAMPLE_CONCURRENCY,
+        help='Threads issuing the sample GETs, shared by --processes')
 
 
 def new_snapper(awscontext, args):
-    return S3Snapper(awscontext, args.bucket_name, args.prefix)
+    return S3Snapper(
+        awscontext, args.bucket_name, args.prefix,
+        checkpoint_file=args.checkpoint_file,
+        checkpoint_interval=args.checkpoint_interval, resume=args.resume,
+        baseline=args.baseline, baseline_index=args.baseline_index,
+        progress_interval=args.progress_interval,
+        previous_snapshot=args.previous_snapshot,
+        queue_records=args.queue_records, batch_records=args.batch_records,
+        processes=args.processes, keep_shards=args.keep_shards,
+        aggregates_file=args.aggregates_file,
+        aggregates_only=args.aggregates_only,
+        aggregate_depth=args.aggregate_depth,
+        sample_rate=args.sample_rate,
+        sample_concurrency=args.sample_concurrency)
@@ -0,0 +1,96 @@
+'''
+In-memory S3 listings for the tests, paged by the ListObjectsV2 of
+benchmarks/fake_aws.py and parsed like botocore responses.
+'''
+
+import argparse
+import os
+import sys
+import xml.etree.ElementTree as ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'snaps'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'benchmarks'))
+
+import fake_aws
+
+
+def _tag(name):
+    return '{{{}}}{}'.format(fake_aws.S3_NS, name)
+
+
+def fake_s3(keys):
+    '''
+    :return: a FakeAWS serving a bucket of ``keys``
+    '''
+
+    parser = argparse.ArgumentParser()
+    fake_aws.add_params(parser)
+    fake = fake_aws.FakeAWS(parser.parse_args(['--keys', '0']))
+    fake.keys = sorted(keys)
+    return fake
+
+
+def list_page(fake, prefix='', start_after=None, delimiter=None,
+              token=None, max_keys=1000):
+    '''
+    :return: a ListObjectsV2 response dict of one page, with LastModified
+    left as listed, like clients created with raw_timestamps
+    '''
+
+    query = {'prefix': prefix, 'max-keys': str(max_keys)}
+    if start_after:
+        query['start-after'] = start_after
+    if delimiter:
+        query['delimiter'] = delimiter
+    if token:
+        query['continuation-token'] = token
+
+    root = ElementTree.fromstring(fake.list_objects_v2(query))
+    response = {
+        'Contents': [
+            {'Key': c.find(_tag('Key')).text,
+             'LastModified': c.find(_tag('LastModified')).text,
+             'Size': int(c.find(_tag('Size')).text),
+             'StorageClass': c.find(_tag('StorageClass')).text}
+            for c in root.findall(_tag('Contents'))],
+        'CommonPrefixes': [
+            {'Prefix': p.find(_tag('Prefix')).text}
+            for p in root.findall(_tag('CommonPrefixes'))],
+    }
+    next_token = root.find(_tag('NextContinuationToken'))
+    if next_token is not None:
+        response['NextContinuationToken'] = next_token.text
+    return response
+
+
+def list_pages(fake, prefix='', start_after=None, delimiter=None,
+               max_keys=1000):
+    '''
+    Page through a listing
+    :return: a generator of ListObjectsV2 response dicts
+    '''
+
+    token = None
+    while 1:
+        response = list_page(
+            fake, prefix, start_after, delimiter, token, max_keys)
+        yield response
+        token = response.get('NextContinuationToken')
+        if not token:
+            break
+
+
+class FakeClient(object):
+    '''
+    Stand-in for an S3 client listing a FakeAWS bucket
+    '''
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def list_objects_v2(self, Prefix='', StartAfter=None, Delimiter=None,
+                        ContinuationToken=None, MaxKeys=1000, **kwargs):
+        return list_page(self.fake, Prefix, StartAfter, Delimiter,
+                         ContinuationToken, MaxKeys)
@@ -0,0 +1,174 @@
+'''
+Tests of diffing S3 listings against a baseline snapshot with
+snaps/s3_baseline.py, against in-memory listings.
+
+    python -m unittest discover -s tests
+'''
+
+import bisect
+import os
+import shutil
+import tempfile
+import unittest
+
+# Sets up sys.path for the modules below
+import s3_listing
+
+import event_writer
+import fake_aws
+import s3_baseline
+import s3_records
+import s3_snap
+
+
+PREFIX = 'AWSLogs/'
+LAST_MODIFIED = s3_records.parse_time(fake_aws.LAST_MODIFIED)
+
+
+class BaselineCursorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='test_s3_baseline.')
+        self.keys = fake_aws.gen_keys(2000, 4, 0.0) + [
+            PREFIX + 'a.txt', PREFIX + 'z.txt']
+        self.keys.sort()
+        self.cursors = []
+
+    def tearDown(self):
+        for cursor in self.cursors:
+            cursor.close()
+        shutil.rmtree(self.workdir)
+
+    def baseline(self, records):
+        '''
+        :param records: (key, size) of the previous snapshot, written
+        unsorted as resumed and sharded snapshots are
+        '''
+
+        fname = os.path.join(self.workdir, 's3_meta.json')
+        with event_writer.JsonEventWriter(fname) as writer:
+            writer.write([
+                s3_records.KeyMeta(key, size, LAST_MODIFIED, 'STANDARD')
+                for key, size in reversed(records)])
+        return s3_baseline.S3Baseline.build(fname)
+
+    def cursor(self, baseline, key_range):
+        cursor = baseline.cursor(key_range)
+        self.cursors.append(cursor)
+        return cursor
+
+    def listed(self):
+        ''':return: (key, size) as listed by the fake'''
+        return [(key, len(key) * 1000) for key in self.keys]
+
+    def diff(self, cursor, fake, key_range, delimiter=None):
+        '''
+        Diff a listing of ``key_range`` page by page
+        :return: (key, change type) of the changes
+        '''
+
+        changes = []
+        for response in s3_listing.list_pages(
+                fake, key_range.prefix, key_range.start_after(), delimiter,
+                max_keys=100):
+            if delimiter:
+                key_metas = s3_records.from_listing(response['Contents'])
+                changes.extend(cursor.diff_level(key_metas, [
+                    p['Prefix'] for p in response['CommonPrefixes']]))
+                continue
+
+            contents, reached_upper = key_range.clip(response['Contents'])
+            changes.extend(cursor.diff(s3_records.from_listing(contents)))
+            if reached_upper:
+                break
+        changes.extend(cursor.drain())
+        return [(meta.key, meta.change_type) for meta in changes]
+
+    def test_diff(self):
+        listed = self.listed()
+        deleted = [(PREFIX + '0001/gone', 1), (PREFIX + 'b.txt', 2),
+                   (PREFIX + 'zz/gone', 3)]
+        previous = listed[:100] + deleted + [
+            (key, size + 1) for key, size in listed[100:110]] + listed[150:]
+        fake = s3_listing.fake_s3(self.keys)
+
+        changes = self.diff(
+            self.cursor(self.baseline(previous), s3_snap.KeyRange(PREFIX)),
+            fake, s3_snap.KeyRange(PREFIX))
+        expected = sorted(
+            [(key, s3_baseline.DELETED) for key, _ in deleted] +
+            [(key, s3_baseline.MODIFIED) for key in self.keys[100:110]] +
+            [(key, s3_baseline.ADDED) for key in self.keys[110:150]])
+        self.assertEqual(changes, expected)
+
+    def test_diff_key_range(self):
+        listed = self.listed()
+        previous = listed[:300] + listed[310:]
+        fake = s3_listing.fake_s3(self.keys)
+        baseline = self.baseline(previous)
+
+        # Resumed after last_key, with keys past upper left to another range
+        key_range = s3_snap.KeyRange(PREFIX, self.keys[200], self.keys[500],
+                                     last_key=self.keys[250])
+        changes = self.diff(self.cursor(baseline, key_range), fake,
+                            key_range)
+        self.assertEqual(
+            changes,
+            [(key, s3_baseline.ADDED) for key in self.keys[300:310]])
+
+        key_range = s3_snap.KeyRange(PREFIX, self.keys[500], None)
+        self.assertEqual(
+            self.diff(self.cursor(baseline, key_range), fake, key_range), [])
+
+    def test_diff_level(self):
+        listed = self.listed()
+        previous = [(key, size + 1) for key, size in listed] + [
+            (PREFIX + 'b.txt', 1), (PREFIX + '0002x', 1)]
+        fake = s3_listing.fake_s3(self.keys)
+        key_range = s3_snap.KeyRange(PREFIX, discover=True)
+
+        # Keys under the common prefixes are diffed by ranges of their own
+        changes = self.diff(
+            self.cursor(self.baseline(previous), key_range), fake,
+            key_range, '/')
+        self.assertEqual(changes, [
+            (PREFIX + '0002x', s3_baseline.DELETED),
+            (PREFIX + 'a.txt', s3_baseline.MODIFIED),
+            (PREFIX + 'b.txt', s3_baseline.DELETED),
+            (PREFIX + 'z.txt', s3_baseline.MODIFIED)])
+
+    def test_skip_prefix(self):
+        previous = [(PREFIX + 'a.txt', 1)] + [
+            (PREFIX + '0001/{:04d}'.format(i), 1) for i in xrange(500)] + [
+            (PREFIX + '0001x', 1), (PREFIX + '0002/a', 1)]
+        cursor = self.cursor(self.baseline(previous),
+                             s3_snap.KeyRange(PREFIX, discover=True))
+
+        changes = cursor._skip_prefix(PREFIX + '0001/')
+        self.assertEqual(changes, [])
+        self.assertEqual(cursor._record[0], PREFIX + '0001x')
+
+        changes = cursor._skip_prefix(PREFIX + '0003/')
+        self.assertEqual(
+            [(meta.key, meta.change_type) for meta in changes],
+            [(PREFIX + '0001x', s3_baseline.DELETED),
+             (PREFIX + '0002/a', s3_baseline.DELETED)])
+        self.assertEqual(cursor._record[0], PREFIX + 'a.txt')
+
+    def test_seek(self):
+        cursor = self.cursor(self.baseline(self.listed()),
+                             s3_snap.KeyRange(PREFIX))
+        for key in [''] + self.keys[::97] + [
+                self.keys[-1], PREFIX + '0001/', PREFIX + '0001/2016/09/15',
+                PREFIX + 'b', u'\ufffd']:
+            cursor._seek(key)
+            cursor._advance()
+            i = bisect.bisect_left(self.keys, key)
+            if i < len(self.keys):
+                self.assertEqual(cursor._record[0], self.keys[i], key)
+            else:
+                self.assertEqual(cursor._record, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,272 @@
+'''
+Tests of the S3 key range splitting and scheduling of snaps/s3_snap.py
+against in-memory listings.
+
+    python -m unittest discover -s tests
+'''
+
+import unittest
+
+# Sets up sys.path for the modules below
+import s3_listing
+
+import fake_aws
+import s3_snap
+
+
+PREFIX = 'AWSLogs/'
+
+
+def collect(fake, key_range, max_keys=100):
+    '''
+    List ``key_range`` the way S3Snapper._do_list does
+    :return: the keys collected
+    '''
+
+    keys = []
+    for response in s3_listing.list_pages(
+            fake, key_range.prefix, key_range.start_after(),
+            max_keys=max_keys):
+        contents, reached_upper = key_range.clip(response['Contents'])
+        keys.extend(c['Key'] for c in contents)
+        if contents:
+            key_range.last_key = contents[-1]['Key']
+        if reached_upper or not response['Contents']:
+            break
+    return keys
+
+
+class MidpointTest(unittest.TestCase):
+
+    def test_between_bounds(self):
+        for lo, hi in [
+                (PREFIX, None),
+                (PREFIX + 'a', PREFIX + 'z'),
+                (PREFIX + 'abc', PREFIX + 'abd'),
+                (PREFIX + '0001/2016/09/01/', PREFIX + '0001/2016/09/02/'),
+                (PREFIX + 'a', PREFIX + 'a ')]:
+            mid = s3_snap._midpoint(PREFIX, lo, hi)
+            self.assertTrue(mid.startswith(PREFIX), (lo, hi, mid))
+            self.assertTrue(lo < mid, (lo, hi, mid))
+            if hi is not None:
+                self.assertTrue(mid < hi, (lo, hi, mid))
+
+    def test_upper_outside_prefix_is_unbounded(self):
+        self.assertEqual(
+            s3_snap._midpoint(PREFIX, PREFIX + 'a', 'B'),
+            s3_snap._midpoint(PREFIX, PREFIX + 'a', None))
+
+
+class BisectTest(unittest.TestCase):
+
+    def test_sorted_distinct_points(self):
+        lo, hi = PREFIX + '0000', PREFIX + '0004'
+        points = s3_snap._bisect(PREFIX, lo, hi, 7)
+        self.assertEqual(len(points), 7)
+        self.assertEqual(points, sorted(set(points)))
+        self.assertTrue(all(lo < p < hi for p in points))
+
+    def test_no_points(self):
+        self.assertEqual(s3_snap._bisect(PREFIX, PREFIX, None, 0), [])
+
+
+class KeyRangeTest(unittest.TestCase):
+
+    def test_clip(self):
+        key_range = s3_snap.KeyRange(PREFIX, PREFIX + 'b', PREFIX + 'd')
+        page = [{'Key': PREFIX + c} for c in 'abcde']
+        contents, reached_upper = key_range.clip(page)
+        self.assertEqual([c['Key'] for c in contents],
+                         [PREFIX + 'b', PREFIX + 'c'])
+        self.assertTrue(reached_upper)
+
+        contents, reached_upper = key_range.clip(page[1:3])
+        self.assertEqual(len(contents), 2)
+        self.assertFalse(reached_upper)
+        self.assertEqual(key_range.clip([]), ([], False))
+        self.assertEqual(key_range.clip(None), ([], False))
+
+    def test_split(self):
+        key_range = s3_snap.KeyRange(PREFIX, PREFIX + 'b', PREFIX + 'x',
+                                     last_key=PREFIX + 'd')
+        pieces = key_range.split(
+            [PREFIX + 'p', PREFIX + 'c', PREFIX + 'd', PREFIX + 'h',
+             PREFIX + 'h', PREFIX + 'y'])
+        # Boundaries up to last_key and at or past upper are dropped
+        self.assertEqual(key_range.upper, PREFIX + 'h')
+        self.assertEqual(
+            [(p.lower, p.upper) for p in pieces],
+            [(PREFIX + 'h', PREFIX + 'p'), (PREFIX + 'p', PREFIX + 'x')])
+        self.assertEqual(key_range.split([PREFIX + 'a']), [])
+
+    def test_split_ranges_cover_listing(self):
+        keys = fake_aws.gen_keys(3000, 4, 0.5)
+        fake = s3_listing.fake_s3(keys)
+        key_range = s3_snap.KeyRange(PREFIX)
+        collected = []
+        for response in s3_listing.list_pages(fake, PREFIX, max_keys=250):
+            contents, _ = key_range.clip(response['Contents'])
+            collected.extend(c['Key'] for c in contents)
+            key_range.last_key = contents[-1]['Key']
+            break
+
+        pieces = key_range.split(
+            s3_snap._bisect(PREFIX, key_range.last_key, keys[-1], 15))
+        self.assertEqual(pieces[-1].upper, None)
+        num_keys = []
+        for piece in [key_range] + pieces:
+            piece_keys = collect(fake, piece)
+            collected.extend(piece_keys)
+            num_keys.append(len(piece_keys))
+        self.assertEqual(collected, keys)
+        self.assertTrue(len([n for n in num_keys if n]) > 2, num_keys)
+
+    def test_resume_from_last_key(self):
+        keys = fake_aws.gen_keys(500, 2, 0.0)
+        fake = s3_listing.fake_s3(keys)
+        key_range = s3_snap.KeyRange(PREFIX, keys[100], keys[400],
+                                     last_key=keys[199])
+        self.assertEqual(collect(fake, key_range), keys[200:400])
+
+
+class RangeSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spawned = 0
+        self.finished = 0
+        self.scheduler = s3_snap.RangeScheduler(
+            2, self._spawn, self._finish)
+
+    def _spawn(self):
+        self.spawned += 1
+
+    def _finish(self):
+        self.finished += 1
+
+    def test_start_without_ranges_finishes(self):
+        self.scheduler.start()
+        self.assertEqual(self.spawned, 0)
+        self.assertEqual(self.finished, 1)
+
+    def test_spawns_up_to_max_workers(self):
+        for i in xrange(5):
+            self.scheduler.put(s3_snap.KeyRange(str(i)))
+        # Nothing runs before start()
+        self.assertEqual(self.spawned, 0)
+        self.assertEqual(self.scheduler.idle_workers(), 0)
+
+        self.scheduler.start()
+        self.assertEqual(self.spawned, 2)
+
+        done = []
+        tasks = 2
+        while tasks:
+            tasks -= 1
+            key_range = self.scheduler.get()
+            if key_range is None:
+                continue
+            if key_range.prefix == '0':
+                # Split off while running
+                self.scheduler.put(s3_snap.KeyRange('0a'))
+            done.append(key_range.prefix)
+            spawned = self.spawned
+            self.scheduler.task_done()
+            tasks += self.spawned - spawned
+
+        self.assertEqual(sorted(done), ['0', '0a', '1', '2', '3', '4'])
+        self.assertEqual(self.spawned, 6)
+        self.assertEqual(self.finished, 1)
+        self.assertEqual(self.scheduler.idle_workers(), 2)
+
+    def test_idle_workers(self):
+        self.scheduler.put(s3_snap.KeyRange('a'))
+        self.scheduler.start()
+        self.assertEqual(self.spawned, 1)
+        self.assertEqual(self.scheduler.idle_workers(), 0)
+
+        key_range = self.scheduler.get()
+        self.assertEqual(key_range.prefix, 'a')
+        self.assertEqual(self.scheduler.idle_workers(), 1)
+        self.scheduler.task_done()
+        self.assertEqual(self.finished, 1)
+
+
+class StubContext(object):
+
+    def __init__(self, queued):
+        self.region = 'us-east-1'
+        self.pool = self
+        self._queued = list(queued)
+
+    def queued(self):
+        # Tasks of other snaps arrive at any time
+        return self._queued.pop(0) if len(self._queued) > 1 \
+            else self._queued[0]
+
+
+class StubScheduler(object):
+
+    def __init__(self, idle):
+        self._idle = list(idle)
+        self.ranges = []
+
+    def idle_workers(self):
+        return self._idle.pop(0) if len(self._idle) > 1 else self._idle[0]
+
+    def put(self, key_range):
+        self.ranges.append(key_range)
+
+
+class StubQueue(object):
+
+    def __init__(self):
+        self.batches = []
+
+    def put(self, batch, num_records=1):
+        self.batches.append(batch)
+
+
+class StubProgress(object):
+    keys = 0
+    size = 0
+
+
+class DoListTest(unittest.TestCase):
+    '''
+    Keys listed ahead of a split or yield must reach the writer
+    '''
+
+    def do_list(self, queued, idle):
+        keys = fake_aws.gen_keys(5000, 4, 0.0)
+        snapper = s3_snap.S3Snapper(StubContext(queued), 'bucket', PREFIX)
+        scheduler = StubScheduler(idle)
+        result_q = StubQueue()
+        key_range = s3_snap.KeyRange(PREFIX)
+        params = {'Bucket': 'bucket', 'Prefix': PREFIX, 'MaxKeys': 100}
+        snapper._do_list(
+            s3_listing.FakeClient(s3_listing.fake_s3(keys)), params,
+            key_range, None, scheduler, result_q, StubProgress())
+
+        written = []
+        for batch in result_q.batches:
+            written.extend(meta.key for meta in batch.key_metas or [])
+            # The checkpoint moves to last_key with this batch
+            self.assertEqual(written, [
+                key for key in keys if key <= batch.last_key])
+        return keys, written, scheduler
+
+    def test_yield(self):
+        keys, written, scheduler = self.do_list([0, 1], [0])
+        self.assertEqual(scheduler.ranges[-1].last_key, written[-1])
+        self.assertEqual(len(written), 10 * 100)
+
+    def test_split(self):
+        keys, written, scheduler = self.do_list([0], [0, 2, 0])
+        self.assertTrue(scheduler.ranges)
+        # The range carries on up to the first piece split off
+        self.assertEqual(written, [
+            key for key in keys if key < scheduler.ranges[0].lower])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+'''
+Kill-and-resume tests of S3 snaps with checkpoints, run as processes
+against benchmarks/fake_aws.py.
+
+    python -m unittest discover -s tests
+'''
+
+import gzip
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+# Sets up sys.path for the modules below
+import s3_listing
+
+import event_writer
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+NUM_KEYS = 20000
+
+
+class ResumeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'benchmarks', 'fake_aws.py'),
+             '--keys', str(NUM_KEYS), '--prefixes', '4', '--latency', '0.01'],
+            stdout=subprocess.PIPE)
+        # The port is on the first line
+        cls.port = int(cls.server.stdout.readline())
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.kill()
+        cls.server.wait()
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='test_s3_resume.')
+        self.checkpoint_file = os.path.join(self.workdir, 's3.checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def snap(self, target_file, *args):
+        argv = [
+            sys.executable, os.path.join(ROOT, 'aws_snaps.py'),
+            '--access_key', 'a', '--secret_key', 'b', '--region',
+            'us-east-1', '--endpoint_url',
+            's3=http://127.0.0.1:{}'.format(self.port),
+            # Slow enough to be killed midway, flushing torn records
+            '--rate_limit', 's3=15', '--write_buffer_size', '1000',
+            '--target_file', target_file, 's3', '--bucket_name', 'bucket',
+            '--checkpoint_file', self.checkpoint_file,
+            '--checkpoint_interval', '1'] + list(args)
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.Popen(argv, stderr=devnull)
+
+    def kill_and_resume(self, target_file, torn):
+        process = self.snap(target_file)
+        deadline = time.time() + 60
+        while (not os.path.exists(self.checkpoint_file) and
+               time.time() < deadline):
+            time.sleep(0.1)
+        time.sleep(0.5)
+        if process.poll() is None:
+            os.kill(process.pid, signal.SIGKILL)
+        process.wait()
+
+        # Whatever the kill left behind, the tail after the checkpoint may
+        # be torn
+        with open(target_file, 'ab') as f:
+            f.write(torn)
+
+        process = self.snap(target_file, '--resume')
+        self.assertEqual(process.wait(), 0)
+
+        keys = [event['Key'] for event in event_writer.iter_events(
+            target_file)]
+        self.assertEqual(len(keys), NUM_KEYS)
+        self.assertEqual(len(set(keys)), NUM_KEYS)
+
+    def test_json(self):
+        self.kill_and_resume(
+            os.path.join(self.workdir, 's3_meta.json'), '{"Key": "AWSL')
+
+    def test_gzip(self):
+        member = os.path.join(self.workdir, 'member.gz')
+        with gzip.GzipFile(member, 'wb') as f:
+            f.write('{"Key": "AWSLogs/torn"}\n' * 1000)
+        with open(member, 'rb') as f:
+            unfinished = f.read()[:-40]
+
+        target_file = os.path.join(self.workdir, 's3_meta.json.gz')
+        self.kill_and_resume(target_file, unfinished)
+        # Every member is complete
+        with gzip.GzipFile(target_file) as f:
+            self.assertEqual(len(f.read().splitlines()), NUM_KEYS)
+
+
+if __name__ == '__main__':
+    unittest.main()
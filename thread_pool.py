@@ -0,0 +1,67 @@
+import logging
+import Queue
+import threading
+import traceback
+
+
+class ThreadPool(object):
+    '''
+    A fixed number of daemon threads draining a shared task queue, so
+    snappers sharing it stay within one concurrency limit. Threads are
+    started on the first submit.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self._tasks = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        if not self._threads:
+            self._start()
+        self._tasks.put((func, args))
+
+    def queued(self):
+        '''
+        :return: number of tasks waiting for a thread
+        '''
+        return self._tasks.qsize()
+
+    def shutdown(self):
+        '''
+        Let the threads finish queued tasks and wait for them to exit
+        '''
+
+        with self._lock:
+            threads, self._threads = self._threads, []
+
+        for thread in threads:
+            self._tasks.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+
+            for i in xrange(self.size):
+                thread = threading.Thread(target=self._run)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while 1:
+            task = self._tasks.get()
+            if task is None:
+                break
+
+            func, args = task
+            try:
+                func(*args)
+            except Exception:
+                logging.error(
+                    'Failed to run task=%s error=%s',
+                    func.__name__, traceback.format_exc())